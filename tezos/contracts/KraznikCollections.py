@@ -1,3 +1,8 @@
+import contextlib
+import functools
+import os
+import time
+
 import smartpy as sp
 
 #The FA2 Config class is used to set up basic configuration settings for the contract
@@ -14,7 +19,12 @@ class FA2_config:
                  store_total_supply                 = True,
                  lazy_entry_points                  = False,
                  allow_self_transfer                = False,
-                 use_token_metadata_offchain_view   = False
+                 use_token_metadata_offchain_view   = False,
+                 instrumented                       = False,
+                 add_marketplace                    = False,
+                 support_permits                    = False,
+                 add_onchain_views                  = False,
+                 emit_events                        = True
                  ):
 
         # The option 'debug_mode' makes the code generation use
@@ -80,6 +90,33 @@ class FA2_config:
 
         self.allow_self_transfer = allow_self_transfer
         # Authorize call of `transfer` entry_point from self
+
+        self.instrumented = instrumented
+        # Count big-map accesses, operator checks, set inserts and loop
+        # steps in a `counters` storage record, to profile the cost of each
+        # entry point. The counting code is not generated at all when this
+        # is `False`, which is what production builds must use.
+
+        self.add_marketplace = add_marketplace
+        # Add `list_token`, `cancel_listing` and `buy` entry points: a sale
+        # is then settled in one call instead of going through an operator
+        # and a marketplace contract.
+
+        self.support_permits = support_permits
+        # Add a `permit_transfer` entry point: owners sign transfers
+        # off-chain and a relayer submits many of them in one operation.
+
+        self.add_onchain_views = add_onchain_views
+        # Add on-chain views (`get_balance`, `is_operator`, `total_supply`
+        # and `owner_of`) that other contracts can call synchronously
+        # instead of going through the `balance_of` callback. `owner_of`
+        # needs a `token-id -> owner` big-map maintained by every transfer.
+
+        self.emit_events = emit_events
+        # Emit contract events (one per call, with typed payloads) from the
+        # entry points that change balances, operators or token metadata,
+        # so that indexers do not have to diff big-maps; see
+        # `tezos/tools/kraznik_events.py` for the decoder.
         name = "FA2"
         if debug_mode:
             name += "-debug"
@@ -103,8 +140,22 @@ class FA2_config:
             name += "-lep"
         if allow_self_transfer:
             name += "-self_transfer"
+        if instrumented:
+            name += "-instrumented"
+        if add_marketplace:
+            name += "-market"
+        if support_permits:
+            name += "-permits"
+        if add_onchain_views:
+            name += "-onchain_views"
+        if not emit_events:
+            name += "-no_events"
         self.name = name
 
+        # Type trees built by the helpers decorated with `cached_type`,
+        # shared by every contract built with this configuration.
+        self._type_cache = {}
+
 ## ## Auxiliary Classes and Values
 ##
 ## The definitions below implement SmartML-types and functions for various
@@ -112,6 +163,22 @@ class FA2_config:
 ##
 token_id_type = sp.TNat
 
+## Large generated scenarios call the type constructors below tens of
+## thousands of times; SmartPy types are immutable values, so each one is
+## built once per configuration and then shared.
+def cached_type(f):
+    @functools.wraps(f)
+    def cached(self):
+        cache = self.config._type_cache
+        key = f.__qualname__
+        if key in cache:
+            build_profile.count("type cache hits")
+        else:
+            build_profile.count("type cache misses")
+            cache[key] = f(self)
+        return cache[key]
+    return cached
+
 class Error_message:
     def __init__(self, config):
         self.config = config
@@ -125,6 +192,7 @@ class Error_message:
     def not_admin(self):             return self.make("NOT_ADMIN")
     def not_admin_or_operator(self): return self.make("NOT_ADMIN_OR_OPERATOR")
     def paused(self):                return self.make("PAUSED")
+    def missigned(self):             return self.make("MISSIGNED")
 
 class Kraznik_error_message:
     def __init__(self):
@@ -146,6 +214,12 @@ class Kraznik_error_message:
 
     def invalid_presale_owner(self): return self.make("NOT_AUTHORISED_FOR_PRESALE")
 
+    def not_listed(self): return self.make("NOT_LISTED")
+
+    def incorrect_amount(self): return self.make("INCORRECT_AMOUNT")
+
+    def invalid_price(self): return self.make("INVALID_PRICE")
+
 #Batch_transfer class is used to handle batching of token transfers
 # transfer type - 
 # {
@@ -161,6 +235,7 @@ class Kraznik_error_message:
 class Batch_transfer:
     def __init__(self, config):
         self.config = config
+    @cached_type
     def get_transfer_type(self):
         tx_type = sp.TRecord(to_ = sp.TAddress,
                              token_id = token_id_type,
@@ -174,6 +249,7 @@ class Batch_transfer:
                                        ("from_", "txs"))
         #Transfer type -> (From, txs -> List of records (to, token ID, amount))
         return transfer_type
+    @cached_type
     def get_type(self):
         #Returns a list of transfers
         return sp.TList(self.get_transfer_type())
@@ -186,6 +262,7 @@ class Batch_transfer:
 class Operator_param:
     def __init__(self, config):
         self.config = config
+    @cached_type
     def get_type(self):
         t = sp.TRecord(
             owner = sp.TAddress,
@@ -218,12 +295,14 @@ class Ledger_key:
 class Operator_set:
     def __init__(self, config):
         self.config = config
+    @cached_type
     def inner_type(self):
         #The type of a record in the Operators set -> (owner address, operator address, token ID)
         return sp.TRecord(owner = sp.TAddress,
                           operator = sp.TAddress,
                           token_id = token_id_type
                           ).layout(("owner", ("operator", "token_id")))
+    @cached_type
     def key_type(self):
         if self.config.readable:
             return self.inner_type()
@@ -247,19 +326,72 @@ class Operator_set:
     def is_member(self, set, owner, operator, token_id):
         return set.contains(self.make_key(owner, operator, token_id))
 
+## Permits (in the spirit of TZIP-017): the owner of the tokens signs the
+## packed `(chain-id, contract, nonce, transfer)` and anybody can submit the
+## signed transfer. The per-owner nonce makes each signature usable once.
+class Permit:
+    def __init__(self, config):
+        self.config = config
+        self.batch_transfer = Batch_transfer(config)
+    @cached_type
+    def get_type(self):
+        return sp.TRecord(public_key = sp.TKey,
+                          signature = sp.TSignature,
+                          transfer = self.batch_transfer.get_transfer_type()
+                          ).layout(("public_key", ("signature", "transfer")))
+    @cached_type
+    def payload_type(self):
+        return sp.TRecord(chain_id = sp.TChainId,
+                          contract = sp.TAddress,
+                          nonce = sp.TNat,
+                          transfer = self.batch_transfer.get_transfer_type()
+                          ).layout(("chain_id", ("contract", ("nonce", "transfer"))))
+    def payload(self, chain_id, contract, nonce, transfer):
+        return sp.pack(sp.set_type_expr(
+            sp.record(chain_id = chain_id, contract = contract, nonce = nonce, transfer = transfer),
+            self.payload_type()))
+    def make(self, public_key, signature, transfer):
+        r = sp.record(public_key = public_key, signature = signature, transfer = transfer)
+        return sp.set_type_expr(r, self.get_type())
+
+## Events: every call emits at most one event per tag, whose payload
+## covers the whole batch; an empty batch emits nothing.
+## - `transfer`: the list of transfers, as passed to `transfer`,
+## - `mint`: the minter, the first token id and the number of tokens,
+## - `operators`: the list of operator updates, as passed to
+##   `update_operators`,
+## - `token_metadata`: the list of the token ids whose metadata changed.
+class Event:
+    def __init__(self, config):
+        self.config = config
+        self.batch_transfer = Batch_transfer(config)
+    @cached_type
+    def mint_type(self):
+        return sp.TRecord(owner = sp.TAddress,
+                          token_id = token_id_type,
+                          count = sp.TNat).layout(("owner", ("token_id", "count")))
+    def mint(self, owner, token_id, count):
+        return sp.set_type_expr(sp.record(owner = owner, token_id = token_id, count = count),
+                                self.mint_type())
+    def transfers(self, transfers):
+        return sp.set_type_expr(transfers, self.batch_transfer.get_type())
+
 class Balance_of:
     #Record of (Owner address and Token ID)
+    @functools.lru_cache(maxsize = None)
     def request_type():
         return sp.TRecord(
             owner = sp.TAddress,
             token_id = token_id_type).layout(("owner", "token_id"))
     #List of records of ( Record(Owner Address, Token ID), Balance)
+    @functools.lru_cache(maxsize = None)
     def response_type():
         return sp.TList(
             sp.TRecord(
                 request = Balance_of.request_type(),
                 balance = sp.TNat).layout(("request", "balance")))
     #Record of Contract (Response_type) and List of Requests
+    @functools.lru_cache(maxsize = None)
     def entry_point_type():
         return sp.TRecord(
             callback = sp.TContract(Balance_of.response_type()),
@@ -270,6 +402,7 @@ class Token_meta_data:
     def __init__(self, config):
         self.config = config
 
+    @cached_type
     def get_type(self):
         return sp.TRecord(token_id = sp.TNat, token_info = sp.TMap(sp.TString, sp.TBytes))
 
@@ -291,7 +424,7 @@ class Token_id_set:
         return sp.len(metaset)
 
 class Presale:
-    def _init__(self, config):
+    def __init__(self, config):
         self.config = config
     def get_type(self):
         return sp.TMap(tkey = sp.TAddress, tvalue = sp.TNat)
@@ -304,7 +437,7 @@ class Presale:
     def update(self, owner, presale_map, tokens_left):
         presale_map[owner] = tokens_left
     def mint(self, owner, presale_map, tokens):
-        presale_map[owner] = presale_map[owner] - tokens
+        presale_map[owner] = sp.as_nat(presale_map[owner] - tokens)
 
 def mutez_transfer(contract, params):
     sp.verify(sp.sender == contract.data.administrator)
@@ -312,6 +445,89 @@ def mutez_transfer(contract, params):
     sp.set_type(params.amount, sp.TMutez)
     sp.send(params.destination, params.amount)
 
+def reset_counters(contract):
+    sp.verify(sp.sender == contract.data.administrator)
+    contract.data.counters = Counters.empty()
+
+def permit_transfer(contract, params):
+    sp.verify( ~contract.is_paused(), message = contract.error_message.paused())
+    sp.set_type(params, sp.TList(contract.permit.get_type()))
+    if contract.config.emit_events:
+        transfers = sp.local("transfers", sp.list(t = contract.batch_transfer.get_transfer_type()))
+    sp.for permit in params:
+        contract.count("loop_steps")
+        owner = sp.local("owner", sp.to_address(sp.implicit_account(sp.hash_key(permit.public_key))))
+        sp.verify(owner.value == permit.transfer.from_, message = contract.error_message.not_owner())
+        nonce = sp.local("nonce", contract.data.permit_nonces.get(owner.value, 0))
+        sp.verify(sp.check_signature(permit.public_key, permit.signature,
+                                     contract.permit.payload(sp.chain_id, sp.self_address,
+                                                             nonce.value, permit.transfer)),
+                  message = contract.error_message.missigned())
+        contract.data.permit_nonces[owner.value] = nonce.value + 1
+        sp.for tx in permit.transfer.txs:
+            contract.count("loop_steps")
+            contract.transfer_tx(owner.value, tx)
+        if contract.config.emit_events:
+            transfers.value.push(permit.transfer)
+    if contract.config.emit_events:
+        contract.emit_batch("transfer", transfers.value.rev())
+
+## ## Marketplace
+##
+## Listings are kept in a big-map `token-id -> (seller, price)`. A listing
+## is removed as soon as the token leaves the seller, whatever the entry
+## point (see `FA2_core.transfer_tx`), so that it cannot be bought again
+## if the token comes back; `buy` still checks the seller's balance.
+def listing_type():
+    return sp.TRecord(seller = sp.TAddress, price = sp.TMutez).layout(("seller", "price"))
+
+def list_token(contract, params):
+    sp.verify( ~contract.is_paused(), message = contract.error_message.paused())
+    sp.set_type(params, sp.TRecord(token_id = token_id_type, price = sp.TMutez).layout(("token_id", "price")))
+    # `buy` pays the seller with `sp.send`, and the protocol rejects
+    # transfers of 0 tez to implicit accounts.
+    sp.verify(params.price > sp.mutez(0), message = contract.kraznik_error_message.invalid_price())
+    contract.count("ledger_reads")
+    sp.verify(contract.data.ledger.get(contract.ledger_key.make(sp.sender, params.token_id), 0) > 0,
+              message = contract.error_message.insufficient_balance())
+    contract.data.listings[params.token_id] = sp.record(seller = sp.sender, price = params.price)
+
+def cancel_listing(contract, params):
+    sp.set_type(params, token_id_type)
+    sp.verify(contract.data.listings.contains(params), message = contract.kraznik_error_message.not_listed())
+    sp.verify((contract.data.listings[params].seller == sp.sender) | contract.is_administrator(sp.sender),
+              message = contract.error_message.not_owner())
+    del contract.data.listings[params]
+
+def buy(contract, params):
+    sp.verify( ~contract.is_paused(), message = contract.error_message.paused())
+    sp.set_type(params, token_id_type)
+    listing = sp.local("listing", contract.data.listings.get(params, message = contract.kraznik_error_message.not_listed()))
+    sp.verify(sp.amount == listing.value.price, message = contract.kraznik_error_message.incorrect_amount())
+    seller = contract.ledger_key.make(listing.value.seller, params)
+    buyer = contract.ledger_key.make(sp.sender, params)
+    contract.count("ledger_reads", 2)
+    contract.count("ledger_writes", 2)
+    seller_balance = sp.local("seller_balance", contract.data.ledger.get(seller, 0))
+    sp.verify(seller_balance.value > 0, message = contract.error_message.insufficient_balance())
+    contract.data.ledger[seller] = sp.as_nat(seller_balance.value - 1)
+    contract.data.ledger[buyer] = contract.data.ledger.get(buyer, 0) + 1
+    contract.set_owner(params, sp.sender)
+    del contract.data.listings[params]
+    sp.send(listing.value.seller, listing.value.price)
+    contract.emit("transfer", contract.event.transfers([
+        contract.batch_transfer.item(from_ = listing.value.seller,
+                                     txs = [sp.record(to_ = sp.sender, token_id = params, amount = 1)])]))
+
+## Names of the operation counters of the instrumented build (see
+## `FA2_config.instrumented` and `FA2_core.count`).
+class Counters:
+    names = ["ledger_reads", "ledger_writes", "metadata_writes",
+             "operator_checks", "operator_writes", "owner_writes",
+             "set_inserts", "loop_steps"]
+    def empty():
+        return sp.record(**dict([(name, sp.nat(0)) for name in Counters.names]))
+
 
 class FA2_core(sp.Contract):
     def __init__(self, config, metadata, **extra_storage):
@@ -325,8 +541,18 @@ class FA2_core(sp.Contract):
         self.token_meta_data = Token_meta_data(self.config)
         self.batch_transfer    = Batch_transfer(self.config)
         self.presale = Presale(self.config)
+        self.permit = Permit(self.config)
+        self.event = Event(self.config)
         if  self.config.add_mutez_transfer:
             self.transfer_mutez = sp.entry_point(mutez_transfer)
+        if self.config.instrumented:
+            self.reset_counters = sp.entry_point(reset_counters)
+        if self.config.support_permits:
+            self.permit_transfer = sp.entry_point(permit_transfer)
+        if self.config.add_marketplace:
+            self.list_token = sp.entry_point(list_token)
+            self.cancel_listing = sp.entry_point(cancel_listing)
+            self.buy = sp.entry_point(buy)
         if config.lazy_entry_points:
             self.add_flag("lazy-entry-points")
         self.add_flag("initial-cast")
@@ -336,7 +562,7 @@ class FA2_core(sp.Contract):
             token_metadata = self.config.my_map(tkey = sp.TNat, tvalue = self.token_meta_data.get_type()),
             operators = self.operator_set.make(),
             all_tokens = self.token_id_set.empty(),
-            presale_map = self.config.my_map(tkey = sp.TAddress, tvalue = self.tNat),
+            presale_map = self.config.my_map(tkey = sp.TAddress, tvalue = sp.TNat),
             metadata = metadata,
             max_supply=10000,
             max_purchase=2,
@@ -350,6 +576,20 @@ class FA2_core(sp.Contract):
             self.update_initial_storage(
                 total_supply = self.config.my_map(tkey = sp.TNat, tvalue = sp.TNat),
             )
+        if self.config.instrumented:
+            self.update_initial_storage(counters = Counters.empty())
+        if self.config.add_onchain_views:
+            self.update_initial_storage(
+                token_owner = self.config.my_map(tkey = token_id_type, tvalue = sp.TAddress),
+            )
+        if self.config.support_permits:
+            self.update_initial_storage(
+                permit_nonces = self.config.my_map(tkey = sp.TAddress, tvalue = sp.TNat),
+            )
+        if self.config.add_marketplace:
+            self.update_initial_storage(
+                listings = self.config.my_map(tkey = token_id_type, tvalue = listing_type()),
+            )
 
     @sp.entry_point
     def withdraw(self, amount):
@@ -376,8 +616,10 @@ class FA2_core(sp.Contract):
         #List of transfers, where each transfer is  (from, txs -> (to, token ID, amount))
         sp.set_type(params, self.batch_transfer.get_type())
         sp.for transfer in params:
+           self.count("loop_steps")
            current_from = transfer.from_
            sp.for tx in transfer.txs:
+                self.count("loop_steps")
                 #Ensures that ONLY the from address or the contract admin can send this transaction
                 sender_verify = ((self.is_administrator(sp.sender)) |
                                 (current_from == sp.sender))
@@ -385,6 +627,7 @@ class FA2_core(sp.Contract):
                 #If the contract supports operators, this checks whether the sender of the transaction is a valid operator
                 if self.config.support_operator:
                     message = self.error_message.not_operator()
+                    self.count("operator_checks")
                     sender_verify |= (self.operator_set.is_member(self.data.operators,
                                                                   current_from,
                                                                   sp.sender,
@@ -393,55 +636,45 @@ class FA2_core(sp.Contract):
                 if self.config.allow_self_transfer:
                     sender_verify |= (sp.sender == sp.self_address)
                 sp.verify(sender_verify, message = message)
-                #Checks if the token metadata is valid
-                sp.verify(
-                    self.data.token_metadata.contains(tx.token_id),
-                    message = self.error_message.token_undefined()
-                )
-                # If amount is 0 we do nothing now:
-                #Otherwise, changes to the balances of the to and from user are made
-                sp.if (tx.amount > 0):
-                    from_user = self.ledger_key.make(current_from, tx.token_id)
-                    sp.verify(
-                        (self.data.ledger[from_user] >= tx.amount),
-                        message = self.error_message.insufficient_balance())
-                    to_user = self.ledger_key.make(tx.to_, tx.token_id)
-                    self.data.ledger[from_user] = sp.as_nat(
-                        self.data.ledger[from_user] - tx.amount)
-                    sp.if self.data.ledger.contains(to_user):
-                        self.data.ledger[to_user] += tx.amount
-                    sp.else:
-                         self.data.ledger[to_user] = tx.amount
-                sp.else:
-                    pass
+                self.transfer_tx(current_from, tx)
+        self.emit_batch("transfer", params)
 
     @sp.entry_point
     def balance_of(self, params):
 
         sp.verify( ~self.is_paused(), message = self.error_message.paused())
         sp.set_type(params, Balance_of.entry_point_type())
-        
-        def f_process_request(req):
+
+        # Wallet-wide queries often repeat `(owner, token_id)` pairs: we keep
+        # the balances already read in a local map so that every ledger key
+        # is looked up (and every token id checked) at most once per call.
+        # A request costs one lookup in that map, plus the ledger read and
+        # one insertion the first time its pair is seen.
+        known = sp.local("known", sp.map(tkey = sp.TPair(sp.TAddress, token_id_type),
+                                         tvalue = sp.TNat))
+        responses = sp.local("responses", sp.list(t = sp.TRecord(
+            request = Balance_of.request_type(),
+            balance = sp.TNat).layout(("request", "balance"))))
+        balance = sp.local("balance", sp.nat(0))
+        sp.for req in params.requests:
+            self.count("loop_steps")
             user = self.ledger_key.make(req.owner, req.token_id)
-            sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-            sp.if self.data.ledger.contains(user):
-                balance = self.data.ledger[user]
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = balance))
-            sp.else:
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = 0))
-        res = sp.local("responses", params.requests.map(f_process_request))
+            with known.value.get_opt(user).match_cases() as arg:
+                with arg.match("Some") as known_balance:
+                    balance.value = known_balance
+                with arg.match("None"):
+                    self.count("ledger_reads")
+                    sp.verify(self.token_exists(req.token_id), message = self.error_message.token_undefined())
+                    balance.value = self.data.ledger.get(user, 0)
+                    known.value[user] = balance.value
+            responses.value.push(
+                sp.record(
+                    request = sp.record(
+                        owner = sp.set_type_expr(req.owner, sp.TAddress),
+                        token_id = sp.set_type_expr(req.token_id, sp.TNat)),
+                    balance = balance.value))
         destination = sp.set_type_expr(params.callback, sp.TContract(Balance_of.response_type()))
-        sp.transfer(res.value, sp.mutez(0), destination)
+        sp.transfer(responses.value.rev(), sp.mutez(0), destination)
 
     @sp.offchain_view(pure = True)
     def get_balance(self, req):
@@ -452,8 +685,8 @@ class FA2_core(sp.Contract):
                 token_id = sp.TNat
             ).layout(("owner", "token_id")))
         user = self.ledger_key.make(req.owner, req.token_id)
-        sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-        sp.result(self.data.ledger[user])
+        sp.verify(self.token_exists(req.token_id), message = self.error_message.token_undefined())
+        sp.result(self.data.ledger.get(user, 0))
 
     #Used to add/remove operators
     @sp.entry_point
@@ -466,6 +699,8 @@ class FA2_core(sp.Contract):
         ))
         if self.config.support_operator:
             sp.for update in params:
+                self.count("loop_steps")
+                self.count("operator_writes")
                 with update.match_cases() as arg:
                     with arg.match("add_operator") as upd:
                         sp.verify(
@@ -485,14 +720,15 @@ class FA2_core(sp.Contract):
                                                  upd.owner,
                                                  upd.operator,
                                                  upd.token_id)
+            self.emit_batch("operators", params)
         else:
             sp.failwith(self.error_message.operators_unsupported())
 
     @sp.entry_point
     def activate_presale(self):
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
         self.data.presale_active = True
 
-    @sp.entry_point
     def is_presale_active(self):
         return self.data.presale_active
 
@@ -503,6 +739,73 @@ class FA2_core(sp.Contract):
     # this is not part of the standard but can be supported through inheritance.
     def is_administrator(self, sender):
         return sp.bool(False)
+
+    # Moves the balance of one `tx` of a transfer from `from_`, once the
+    # caller has checked that the sender is allowed to do so.
+    def transfer_tx(self, from_, tx):
+        #Checks that the token has been minted
+        sp.verify(
+            self.token_exists(tx.token_id),
+            message = self.error_message.token_undefined()
+        )
+        # If amount is 0 we do nothing now:
+        #Otherwise, changes to the balances of the to and from user are made
+        sp.if (tx.amount > 0):
+            from_user = self.ledger_key.make(from_, tx.token_id)
+            sp.verify(
+                (self.data.ledger[from_user] >= tx.amount),
+                message = self.error_message.insufficient_balance())
+            to_user = self.ledger_key.make(tx.to_, tx.token_id)
+            self.data.ledger[from_user] = sp.as_nat(
+                self.data.ledger[from_user] - tx.amount)
+            self.count("ledger_reads", 3)
+            self.count("ledger_writes", 2)
+            sp.if self.data.ledger.contains(to_user):
+                self.count("ledger_reads")
+                self.data.ledger[to_user] += tx.amount
+            sp.else:
+                 self.data.ledger[to_user] = tx.amount
+            self.set_owner(tx.token_id, tx.to_)
+            if self.config.add_marketplace:
+                sp.if tx.to_ != from_:
+                    del self.data.listings[tx.token_id]
+        sp.else:
+            pass
+
+    # Every minted token has a supply of one, so whoever receives it is its
+    # only owner.
+    def set_owner(self, token_id, owner):
+        if self.config.add_onchain_views:
+            self.count("owner_writes")
+            self.data.token_owner[token_id] = owner
+
+    # Emits a contract event, unless events are disabled in the config.
+    def emit(self, tag, payload):
+        if self.config.emit_events:
+            sp.emit(payload, tag = tag, with_type = True)
+
+    # Same as `emit` for a list payload, which is not emitted when empty.
+    def emit_batch(self, tag, payload):
+        if self.config.emit_events:
+            sp.if sp.len(payload) > 0:
+                sp.emit(payload, tag = tag, with_type = True)
+
+    # Increments one of the `Counters` of the instrumented build; this
+    # generates no code at all for non-instrumented builds.
+    def count(self, counter, n = 1):
+        if self.config.instrumented:
+            counters = self.data.counters
+            setattr(counters, counter, getattr(counters, counter) + n)
+
+    # A token exists once it has been minted, whether or not its metadata
+    # has been set yet; every entry point and view that can fail with
+    # `FA2_TOKEN_UNDEFINED` uses this rule. With consecutive token ids, it
+    # is a comparison against the counter instead of a set lookup.
+    def token_exists(self, token_id):
+        if self.config.assume_consecutive_token_ids:
+            return token_id < self.token_id_set.cardinal(self.data.all_tokens)
+        else:
+            return self.token_id_set.contains(self.data.all_tokens, token_id)
 #Class to handle the admin address of the FA2 contract
 class FA2_administrator(FA2_core):
     def is_administrator(self, sender):
@@ -530,6 +833,23 @@ class FA2_change_metadata(FA2_core):
         self.data.metadata[k] = v
 
 class FA2_mint(FA2_core):
+    # Mints `quantity` consecutive tokens to the sender, starting at the
+    # `token_id` local.
+    def mint_tokens(self, token_id, quantity):
+        self.emit("mint", self.event.mint(sp.sender, token_id.value, quantity))
+        total_tokens = sp.local("total_tokens",token_id.value + quantity)
+        sp.while token_id.value < total_tokens.value:
+           self.count("loop_steps")
+           self.count("ledger_writes")
+           self.count("set_inserts")
+           user = self.ledger_key.make(sp.sender, token_id.value)
+           self.data.ledger[user] = 1
+           self.token_id_set.add(self.data.all_tokens, token_id.value)
+           self.set_owner(token_id.value, sp.sender)
+           if self.config.store_total_supply:
+               self.data.total_supply[token_id.value] = 1
+           token_id.value = token_id.value + 1
+
     @sp.entry_point
     def mint(self, params):
         
@@ -544,17 +864,13 @@ class FA2_mint(FA2_core):
         sp.verify(sp.amount >= sp.mul(self.data.mint_price, params.purchase_quantity),
                   message=self.kraznik_error_message.insufficient_amount_paid())
         
-        total_tokens = sp.local("total_tokens",token_id.value + params.purchase_quantity)
-        sp.while token_id.value < total_tokens.value:
-           user = self.ledger_key.make(sp.sender, token_id.value)
-           self.data.ledger[user] = 1
-           self.token_id_set.add(self.data.all_tokens, token_id.value)
-           token_id.value = token_id.value + 1
+        self.mint_tokens(token_id, params.purchase_quantity)
 
     @sp.entry_point
     def presale_mint(self, params):
+        sp.verify( ~self.is_paused(), message = self.error_message.paused())
         sp.verify( self.is_presale_active(), message = self.kraznik_error_message.presale_inactive())
-        sp.verify( self.presale.is_owner(owner = sp.sender, presale_map = self.data.presale_map), message = self.kraznik_error_message.invalid_presale_owner)
+        sp.verify( self.presale.is_owner(owner = sp.sender, presale_map = self.data.presale_map), message = self.kraznik_error_message.invalid_presale_owner())
         token_id = sp.local("token_id",self.token_id_set.cardinal(self.data.all_tokens))
         sp.verify(params.purchase_quantity > 0)
         sp.verify(params.purchase_quantity <= self.presale.tokens_left(owner = sp.sender, presale_map = self.data.presale_map),
@@ -564,20 +880,23 @@ class FA2_mint(FA2_core):
         sp.verify(sp.amount >= sp.mul(self.data.mint_price, params.purchase_quantity),
                   message=self.kraznik_error_message.insufficient_amount_paid())
         
-        total_tokens = sp.local("total_tokens",token_id.value + params.purchase_quantity)
-        sp.while token_id.value < total_tokens.value:
-           user = self.ledger_key.make(sp.sender, token_id.value)
-           self.data.ledger[user] = 1
-           self.token_id_set.add(self.data.all_tokens, token_id.value)
-           token_id.value = token_id.value + 1
-        self.data.presale.mint(owner = sp.sender, presale_map = self.data.presale_map, tokens = params.purchase_quantity)
+        self.mint_tokens(token_id, params.purchase_quantity)
+        self.presale.mint(owner = sp.sender, presale_map = self.data.presale_map, tokens = params.purchase_quantity)
 
     @sp.entry_point
     def update_token_metadata(self, params):
         sp.set_type(params.metadata, sp.TList(self.token_meta_data.get_type()))
         sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        if self.config.emit_events:
+            token_ids = sp.local("token_ids", sp.list(t = token_id_type))
         sp.for metadata in params.metadata:
+            self.count("loop_steps")
+            self.count("metadata_writes")
             self.data.token_metadata[metadata.token_id] = metadata
+            if self.config.emit_events:
+                token_ids.value.push(metadata.token_id)
+        if self.config.emit_events:
+            self.emit_batch("token_metadata", token_ids.value.rev())
 
 class FA2_token_metadata(FA2_core):
     def set_token_metadata_view(self):
@@ -609,7 +928,7 @@ class Kraznik(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrat
     def does_token_exist(self, tok):
         "Ask whether a token ID is exists."
         sp.set_type(tok, sp.TNat)
-        sp.result(self.data.token_metadata.contains(tok))
+        sp.result(self.token_exists(tok))
 
     @sp.offchain_view(pure = True)
     def all_tokens(self):
@@ -637,6 +956,37 @@ class Kraznik(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrat
                                         query.token_id)
         )
 
+    def set_onchain_views(self):
+        def get_balance(self, req):
+            sp.set_type(req, Balance_of.request_type())
+            sp.verify(self.token_exists(req.token_id), message = self.error_message.token_undefined())
+            sp.result(self.data.ledger.get(self.ledger_key.make(req.owner, req.token_id), 0))
+
+        def is_operator(self, query):
+            sp.set_type(query, self.operator_set.inner_type())
+            sp.result(self.operator_set.is_member(self.data.operators,
+                                                  query.owner,
+                                                  query.operator,
+                                                  query.token_id))
+
+        def total_supply(self, tok):
+            sp.set_type(tok, token_id_type)
+            sp.verify(self.token_exists(tok), message = self.error_message.token_undefined())
+            if self.config.store_total_supply:
+                sp.result(self.data.total_supply.get(tok, 0))
+            else:
+                sp.result(sp.nat(1))
+
+        def owner_of(self, tok):
+            sp.set_type(tok, token_id_type)
+            sp.result(self.data.token_owner.get(tok, message = self.error_message.token_undefined()))
+
+        # The Python names differ from the offchain views of the same name.
+        self.onchain_get_balance = sp.onchain_view(name = "get_balance")(get_balance)
+        self.onchain_is_operator = sp.onchain_view(name = "is_operator")(is_operator)
+        self.onchain_total_supply = sp.onchain_view(name = "total_supply")(total_supply)
+        self.owner_of = sp.onchain_view(name = "owner_of")(owner_of)
+
     def __init__(self, config, metadata, admin):
         # Let's show off some meta-programming:
         if config.assume_consecutive_token_ids:
@@ -664,38 +1014,28 @@ class Kraznik(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrat
 
         if config.store_total_supply:
             list_of_views = list_of_views + [self.total_supply]
+        if config.add_onchain_views:
+            self.set_onchain_views()
         if config.use_token_metadata_offchain_view:
             self.set_token_metadata_view()
             list_of_views = list_of_views + [self.token_metadata]
 
+        # Wallets fetch and parse this document before they can call any
+        # view, so it only carries what they use; the compiled JSON can be
+        # minified and checked against a size budget with
+        # `tezos/tools/metadata_tool.py`.
         metadata_base = {
-            "version": config.name # will be changed if using fatoo.
-            , "description" : (
-                "This is a didactic reference implementation of FA2,"
-                + " a.k.a. TZIP-012, using SmartPy.\n\n"
-                + "This particular contract uses the configuration named: "
-                + config.name + "."
-            )
+            "name": "Kraznik Underverse"
+            , "version": config.name # will be changed if using fatoo.
+            , "description": "Kraznik Underverse collection (FA2 / TZIP-012)."
             , "interfaces": ["TZIP-012", "TZIP-016"]
-            , "authors": [
-                "Seb Mondet <https://seb.mondet.org>"
-            ]
-            , "homepage": "https://gitlab.com/smondet/fa2-smartpy"
             , "views": list_of_views
-            , "source": {
-                "tools": ["SmartPy"]
-                , "location": "https://gitlab.com/smondet/fa2-smartpy.git"
-            }
             , "permissions": {
                 "operator":
                 "owner-or-operator-transfer" if config.support_operator else "owner-transfer"
                 , "receiver": "owner-no-hook"
                 , "sender": "owner-no-hook"
             }
-            , "fa2-smartpy": {
-                "configuration" :
-                dict([(k, getattr(config, k)) for k in dir(config) if "__" not in k and k != 'my_map'])
-            }
         }
         self.init_metadata("metadata_base", metadata_base)
         FA2_core.__init__(self, config, metadata, paused = False, administrator = admin, presale_active = False)
@@ -722,11 +1062,217 @@ class View_consumer(sp.Contract):
             self.data.last_sum += resp.balance
 
 
+## ## Profiling
+##
+## A scenario script does not run anything itself: `scenario += c`,
+## `c.f(...).run(...)` and `scenario.verify(...)` only record actions. Type
+## inference, compilation to Michelson, simulation and the HTML output are
+## done by the SmartPy engine once the script has returned, and are timed
+## per test from outside, by `tezos/tools/profile_build.py`.
+##
+## `Build_profile` breaks down the time of the script itself, i.e. of
+## building contracts and recording the scenario. It is opt-in (environment
+## variable `profile_build=true`) and costs a dictionary lookup per call
+## otherwise. Its phases are:
+## - `contracts`: building contract objects (entry points, types, metadata),
+## - `originations`: recording `scenario += c`,
+## - `calls`: recording entry-point calls and everything else,
+## - `checks`: recording `scenario.verify` checks,
+## - `presentation`: recording headings, paragraphs, `show` and tables of
+##   contents.
+class Build_profile:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+
+    def count(self, name):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        # Each phase is charged its own time only: nested phases are
+        # subtracted from the enclosing one.
+        frame = [time.perf_counter(), 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - frame[1]
+            if self.stack:
+                self.stack[-1][1] += elapsed
+
+    def wrap(self, scenario):
+        if self.enabled:
+            return Profiled_scenario(scenario, self)
+        return scenario
+
+    def report(self, title):
+        if not self.enabled:
+            return
+        total = sum(self.phases.values())
+        print("Scenario script profile: %s (%.1f ms)" % (title, total * 1000))
+        for (name, seconds) in sorted(self.phases.items(), key = lambda kv: -kv[1]):
+            print("  %-12s %9.1f ms  %5.1f%%" % (name, seconds * 1000, 100 * seconds / max(total, 1e-9)))
+        for (name, n) in sorted(self.counters.items()):
+            print("  %-20s %d" % (name, n))
+        self.phases = {}
+        self.counters = {}
+
+class Profiled_scenario:
+    html_methods = ["h1", "h2", "h3", "h4", "p", "show", "table_of_contents"]
+    verify_methods = ["verify", "verify_equal"]
+
+    def __init__(self, scenario, profile):
+        self.scenario = scenario
+        self.profile = profile
+
+    def __iadd__(self, contract):
+        with self.profile.phase("originations"):
+            self.scenario += contract
+        return self
+
+    def __getattr__(self, name):
+        attr = getattr(self.scenario, name)
+        if name in self.html_methods:
+            phase = "presentation"
+        elif name in self.verify_methods:
+            phase = "checks"
+        else:
+            return attr
+        def timed(*args, **kwargs):
+            with self.profile.phase(phase):
+                return attr(*args, **kwargs)
+        return timed
+
+def profiled(title):
+    """Decorator for scenario functions: everything not attributed to a
+    more specific phase is counted as `calls`."""
+    def decorate(f):
+        @functools.wraps(f)
+        def run():
+            with build_profile.phase("calls"):
+                f()
+            build_profile.report(title)
+        return run
+    return decorate
+
+## Registers a scenario function as a SmartPy test named `name`. With the
+## environment variable `only_test=<name>`, only that test is registered;
+## with `list_tests=true`, the test names are printed and no test is
+## registered. `tezos/tools/profile_build.py` uses both to run the engine
+## on one test at a time.
+def kraznik_test(name, is_default = True):
+    def decorate(f):
+        if list_tests:
+            print("test: " + name)
+        elif only_test is None or only_test == name:
+            sp.add_test(name = name, is_default = is_default)(profiled(name)(f))
+        return f
+    return decorate
+
+## ## Headless mode
+##
+## The SmartPy CLI only writes HTML when `SmartPy.sh test` is given
+## `--html`, so CI and local iteration run it without. With the environment
+## variable `headless=true`, scenarios also do not record their
+## presentation (headings, paragraphs, `show`, tables of contents), which
+## the engine would otherwise evaluate and log; contract calls and
+## `scenario.verify` checks are unchanged. The time the engine takes on
+## each test in this mode is measured by
+## `tezos/tools/profile_build.py --headless`.
+class Headless_scenario:
+    def __init__(self, scenario):
+        self.scenario = scenario
+
+    def __iadd__(self, contract):
+        self.scenario += contract
+        return self
+
+    def __getattr__(self, name):
+        if name in Profiled_scenario.html_methods:
+            return lambda *args, **kwargs: None
+        return getattr(self.scenario, name)
+
+def test_scenario():
+    scenario = sp.test_scenario()
+    if headless:
+        scenario = Headless_scenario(scenario)
+    return build_profile.wrap(scenario)
+
+## A contract that reads balances the two possible ways: through the
+## `balance_of` callback (an operation to the FA2 contract and one back) or
+## through the on-chain `get_balance` view (no operation at all).
+class Balance_consumer(sp.Contract):
+    def __init__(self, contract):
+        self.contract = contract
+        self.init(fa2 = contract.address, last_balance = sp.nat(0), last_owner = contract.address)
+
+    @sp.entry_point
+    def request_balance(self, params):
+        sp.set_type(params, Balance_of.request_type())
+        balance_of = sp.contract(Balance_of.entry_point_type(), self.data.fa2,
+                                 entry_point = "balance_of").open_some()
+        callback = sp.self_entry_point("receive_balances")
+        sp.transfer(sp.record(callback = callback, requests = [params]), sp.mutez(0), balance_of)
+
+    @sp.entry_point
+    def receive_balances(self, params):
+        sp.set_type(params, Balance_of.response_type())
+        sp.verify(sp.sender == self.data.fa2)
+        sp.for resp in params:
+            self.data.last_balance = resp.balance
+
+    @sp.entry_point
+    def check_balance(self, params):
+        sp.set_type(params, Balance_of.request_type())
+        self.data.last_balance = sp.view("get_balance", self.data.fa2, params,
+                                         t = sp.TNat).open_some()
+
+    @sp.entry_point
+    def check_owner(self, params):
+        sp.set_type(params, token_id_type)
+        self.data.last_owner = sp.view("owner_of", self.data.fa2, params,
+                                       t = sp.TAddress).open_some()
+
+## A marketplace in the style of the existing ones: the seller makes it an
+## operator of the token, and it calls `transfer` when a buyer pays.
+class Operator_marketplace(sp.Contract):
+    def __init__(self, contract):
+        self.contract = contract
+        self.init(fa2 = contract.address,
+                  listings = sp.big_map(tkey = token_id_type, tvalue = listing_type()))
+
+    @sp.entry_point
+    def list_token(self, params):
+        self.data.listings[params.token_id] = sp.record(seller = sp.sender, price = params.price)
+
+    @sp.entry_point
+    def buy(self, params):
+        sp.set_type(params, token_id_type)
+        listing = sp.local("listing", self.data.listings[params])
+        sp.verify(sp.amount == listing.value.price)
+        transfer = sp.contract(self.contract.batch_transfer.get_type(), self.data.fa2,
+                               entry_point = "transfer").open_some()
+        sp.transfer([self.contract.batch_transfer.item(
+                        from_ = listing.value.seller,
+                        txs = [sp.record(to_ = sp.sender, token_id = params, amount = 1)])],
+                    sp.mutez(0), transfer)
+        sp.send(listing.value.seller, listing.value.price)
+        del self.data.listings[params]
+
 def add_test(config, is_default = True):
-    @sp.add_test(name = config.name, is_default = is_default)
+    @kraznik_test(config.name, is_default = is_default)
     def test():
         #Creates a test scenario
-        scenario = sp.test_scenario()
+        scenario = test_scenario()
         scenario.h1("FA2 Contract Name: " + config.name)
 
         scenario.table_of_contents()
@@ -739,9 +1285,10 @@ def add_test(config, is_default = True):
         scenario.show([admin, alice, bob])
 
 
-        c1 = Kraznik(config = config,
-                 metadata = sp.utils.metadata_of_url("https://example.com"),
-                 admin = admin.address)
+        with build_profile.phase("contracts"):
+            c1 = Kraznik(config = config,
+                     metadata = sp.utils.metadata_of_url("https://example.com"),
+                     admin = admin.address)
         #Register a 'Kraznik' contract 
         scenario += c1
         # if config.non_fungible:
@@ -876,6 +1423,369 @@ def add_test(config, is_default = True):
                 ]).run(sender = op1)
             scenario.table_of_contents()
 
+## ## Benchmarks
+##
+## The benchmarks below are regular scenarios whose interesting output is
+## the gas reported by the simulator for each call.
+
+## Originates a `Kraznik` contract for a benchmark, mints token `i` to
+## `owners[i]` (two tokens per call when they have the same owner), and
+## sets the metadata of all of them in one call.
+def originate_benchmark_contract(scenario, config, admin, owners = ()):
+    with build_profile.phase("contracts"):
+        c = Kraznik(config = config,
+                    metadata = sp.utils.metadata_of_url("https://example.com"),
+                    admin = admin.address)
+    scenario += c
+    tok = 0
+    while tok < len(owners):
+        n = 2 if tok + 1 < len(owners) and owners[tok + 1] is owners[tok] else 1
+        c.mint(purchase_quantity = n).run(sender = owners[tok], amount = sp.tez(69 * n))
+        tok += n
+    if owners:
+        c.update_token_metadata(metadata = sp.list(l = [
+            sp.record(token_id = tok, token_info = sp.map({"" : sp.utils.bytes_of_string("ipfs//::")}))
+            for tok in range(len(owners))
+        ])).run(sender = admin)
+    return c
+
+def add_balance_of_benchmark(config, is_default = True):
+    @kraznik_test("balance_of-benchmark-" + config.name, is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Benchmark: balance_of with 10, 100 and 1,000 requests")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+        # Alice owns tokens 0 to 5, Bob owns tokens 6 to 9.
+        owners = [alice] * 6 + [bob] * 4
+        c1 = originate_benchmark_contract(scenario, config, admin, owners)
+        consumer = View_consumer(c1)
+        scenario += consumer
+
+        # Each size is run twice:
+        # - with requests cycling over 30 distinct `(owner, token_id)` pairs,
+        #   so that the larger calls are dominated by duplicates, like
+        #   wallet-wide queries,
+        # - with all pairs distinct, the worst case for the local map: the
+        #   gas per request of these calls is the one to watch for
+        #   regressions against a plain loop over the ledger.
+        holders = [alice, bob, admin] + [sp.test_account("Holder%d" % i) for i in range(97)]
+        for size in [10, 100, 1000]:
+            for (title, accounts) in [("repeated pairs", holders[:3]),
+                                      ("distinct pairs", holders[:max(1, size // len(owners))])]:
+                scenario.h2("%d requests, %s" % (size, title))
+                requests = []
+                expected = 0
+                for i in range(size):
+                    owner = accounts[i % len(accounts)]
+                    tok = (i // len(accounts)) % len(owners)
+                    requests.append(sp.record(owner = owner.address, token_id = tok))
+                    if owners[tok] is owner:
+                        expected += 1
+                c1.balance_of(sp.record(
+                    callback = sp.contract(
+                        Balance_of.response_type(),
+                        consumer.address,
+                        entry_point = "receive_balances").open_some(),
+                    requests = requests))
+                scenario.verify(consumer.data.last_sum == expected)
+
+## Selling a token through an operator-based marketplace takes 4 signed
+## operations (add operator, list, buy, remove operator) and 2 internal ones
+## (the `transfer` call and the payment); the native entry points take 2
+## signed operations (list, buy) and 1 internal one (the payment).
+def add_marketplace_benchmark(config, is_default = True):
+    assert config.add_marketplace and config.support_operator
+    @kraznik_test("marketplace-benchmark-" + config.name, is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Benchmark: native listings vs. operator-based marketplace")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+        c1 = originate_benchmark_contract(scenario, config, admin, [alice, alice])
+        market = Operator_marketplace(c1)
+        scenario += market
+
+        scenario.h2("Operator-based flow (4 operations + 2 internal)")
+        c1.update_operators([
+            sp.variant("add_operator", c1.operator_param.make(
+                owner = alice.address, operator = market.address, token_id = 0))
+        ]).run(sender = alice)
+        market.list_token(token_id = 0, price = sp.tez(10)).run(sender = alice)
+        market.buy(0).run(sender = bob, amount = sp.tez(10))
+        c1.update_operators([
+            sp.variant("remove_operator", c1.operator_param.make(
+                owner = alice.address, operator = market.address, token_id = 0))
+        ]).run(sender = alice)
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, 0)] == 1)
+
+        scenario.h2("Native flow (2 operations + 1 internal)")
+        c1.list_token(token_id = 1, price = sp.tez(10)).run(sender = alice)
+        c1.buy(1).run(sender = bob, amount = sp.tez(9), valid = False)
+        c1.buy(1).run(sender = bob, amount = sp.tez(10))
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(alice.address, 1)] == 0)
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, 1)] == 1)
+        scenario.verify(~ c1.data.listings.contains(1))
+
+        scenario.h2("Stale and cancelled listings")
+        c1.list_token(token_id = 1, price = sp.tez(5)).run(sender = alice, valid = False)
+        c1.list_token(token_id = 1, price = sp.tez(5)).run(sender = bob)
+        c1.cancel_listing(1).run(sender = alice, valid = False)
+        c1.cancel_listing(1).run(sender = bob)
+        c1.buy(1).run(sender = alice, amount = sp.tez(5), valid = False)
+        c1.list_token(token_id = 1, price = sp.mutez(0)).run(
+            sender = bob, valid = False, exception = "Kraznik_INVALID_PRICE")
+        c1.list_token(token_id = 1, price = sp.tez(5)).run(sender = bob)
+        c1.transfer([
+            c1.batch_transfer.item(from_ = bob.address,
+                                   txs = [sp.record(to_ = admin.address, amount = 1, token_id = 1)])
+        ]).run(sender = bob)
+        scenario.verify(~ c1.data.listings.contains(1))
+        c1.buy(1).run(sender = alice, amount = sp.tez(5), valid = False)
+
+        scenario.h2("A listing does not survive the token leaving and coming back")
+        c1.transfer([
+            c1.batch_transfer.item(from_ = admin.address,
+                                   txs = [sp.record(to_ = bob.address, amount = 1, token_id = 1)])
+        ]).run(sender = admin)
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, 1)] == 1)
+        c1.buy(1).run(sender = alice, amount = sp.tez(5), valid = False,
+                      exception = "Kraznik_NOT_LISTED")
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, 1)] == 1)
+
+## A relayer submits the signed transfers of 1, 10 and 50 users in one
+## `permit_transfer` call each; the gas of a call divided by the batch size
+## is the amortised cost of a transfer. The keys are deterministic test
+## accounts, so signatures are computed offline by the scenario.
+def add_permit_benchmark(config, is_default = True, batch_sizes = (1, 10, 50)):
+    assert config.support_permits
+    @kraznik_test("permit-benchmark-" + config.name, is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Benchmark: relayed transfers with permits")
+        admin = sp.test_account("Administrator")
+        relayer = sp.test_account("Relayer")
+        bob = sp.test_account("Robert")
+        chain_id = sp.chain_id_cst("0x9caecab9")
+
+        # Every user owns one token and is in exactly one batch.
+        users = [sp.test_account("User%d" % i) for i in range(sum(batch_sizes))]
+        c1 = originate_benchmark_contract(scenario, config, admin, users)
+
+        def to_bob(user, token_id):
+            return c1.batch_transfer.item(
+                from_ = user.address,
+                txs = [sp.record(to_ = bob.address, amount = 1, token_id = token_id)])
+
+        # The permit always carries the public key of `user`, the owner of
+        # the tokens; `signer` makes the signature.
+        def signed_transfer(user, token_id, nonce, signer = None):
+            signer = signer or user
+            transfer = to_bob(user, token_id)
+            signature = sp.make_signature(
+                signer.secret_key,
+                c1.permit.payload(chain_id, c1.address, nonce, transfer),
+                message_format = "Raw")
+            return c1.permit.make(user.public_key, signature, transfer)
+
+        first = 0
+        for size in batch_sizes:
+            scenario.h2("Batch of %d transfers" % size)
+            batch = [signed_transfer(users[i], i, 0) for i in range(first, first + size)]
+            c1.permit_transfer(batch).run(sender = relayer, chain_id = chain_id)
+            first += size
+        for i in range(len(users)):
+            scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, i)] == 1)
+
+        scenario.h2("Replayed, forged and misdirected permits are rejected")
+        c1.mint(purchase_quantity = 1).run(sender = users[0], amount = sp.tez(69))
+        tok = len(users)
+        c1.permit_transfer([signed_transfer(users[0], tok, 0)]).run(
+            sender = relayer, chain_id = chain_id, valid = False, exception = "FA2_MISSIGNED")
+        c1.permit_transfer([signed_transfer(users[0], tok, 1, signer = users[1])]).run(
+            sender = relayer, chain_id = chain_id, valid = False, exception = "FA2_MISSIGNED")
+        c1.permit_transfer([signed_transfer(users[0], tok, 1)]).run(
+            sender = relayer, chain_id = sp.chain_id_cst("0x00000000"), valid = False,
+            exception = "FA2_MISSIGNED")
+        # A valid signature by someone else, with their own key, is not
+        # enough either: the key must be the one of the owner.
+        stolen = to_bob(users[0], tok)
+        c1.permit_transfer([c1.permit.make(
+            users[1].public_key,
+            sp.make_signature(users[1].secret_key,
+                              c1.permit.payload(chain_id, c1.address, 0, stolen),
+                              message_format = "Raw"),
+            stolen)]).run(
+            sender = relayer, chain_id = chain_id, valid = False, exception = "FA2_NOT_OWNER")
+        c1.permit_transfer([signed_transfer(users[0], tok, 1)]).run(sender = relayer, chain_id = chain_id)
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(bob.address, tok)] == 1)
+        scenario.verify(c1.data.permit_nonces[users[0].address] == 2)
+
+## Reading a balance from another contract: `request_balance` goes through
+## `balance_of` and its callback (1 operation + 2 internal ones),
+## `check_balance` through the on-chain view (1 operation).
+def add_onchain_view_benchmark(config, is_default = True):
+    assert config.add_onchain_views
+    @kraznik_test("onchain-views-benchmark-" + config.name, is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Benchmark: on-chain views vs. balance_of callbacks")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+        c1 = originate_benchmark_contract(scenario, config, admin, [alice, alice])
+        consumer = Balance_consumer(c1)
+        scenario += consumer
+
+        scenario.h2("balance_of callback (1 operation + 2 internal)")
+        consumer.request_balance(sp.record(owner = alice.address, token_id = 0)).run(sender = bob)
+        scenario.verify(consumer.data.last_balance == 1)
+
+        scenario.h2("On-chain view (1 operation)")
+        consumer.check_balance(sp.record(owner = bob.address, token_id = 0)).run(sender = bob)
+        scenario.verify(consumer.data.last_balance == 0)
+        consumer.check_balance(sp.record(owner = alice.address, token_id = 1)).run(sender = bob)
+        scenario.verify(consumer.data.last_balance == 1)
+        consumer.check_balance(sp.record(owner = alice.address, token_id = 7)).run(sender = bob, valid = False)
+
+        scenario.h2("Ownership follows transfers")
+        consumer.check_owner(0).run(sender = bob)
+        scenario.verify(consumer.data.last_owner == alice.address)
+        c1.transfer([
+            c1.batch_transfer.item(from_ = alice.address,
+                                   txs = [sp.record(to_ = bob.address, amount = 1, token_id = 0)])
+        ]).run(sender = alice)
+        consumer.check_owner(0).run(sender = bob)
+        scenario.verify(consumer.data.last_owner == bob.address)
+        scenario.verify(sp.view("total_supply", c1.address, sp.nat(0),
+                                t = sp.TNat).open_some() == 1)
+        scenario.verify(~ sp.view("is_operator", c1.address,
+                                  sp.record(owner = bob.address, operator = alice.address, token_id = 0),
+                                  t = sp.TBool).open_some())
+
+## The same calls on a contract with events and on one without; the gas
+## difference of each pair of calls is the overhead of the events.
+def add_event_benchmark(is_default = True):
+    @kraznik_test("events-benchmark", is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Benchmark: gas overhead of events")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+        op1   = sp.test_account("Operator1")
+        for config in [FA2_config(emit_events = False), FA2_config(emit_events = True)]:
+            scenario.h2(config.name)
+            scenario.h3("mint (6 x 2 tokens), update_token_metadata (12 tokens)")
+            c = originate_benchmark_contract(scenario, config, admin, [alice] * 12)
+            scenario.h3("update_operators (1 add)")
+            c.update_operators([
+                sp.variant("add_operator", c.operator_param.make(
+                    owner = alice.address, operator = op1.address, token_id = 0))
+            ]).run(sender = alice)
+            scenario.h3("transfer (1 tx)")
+            c.transfer([
+                c.batch_transfer.item(from_ = alice.address,
+                                      txs = [sp.record(to_ = bob.address, amount = 1, token_id = 0)])
+            ]).run(sender = op1)
+            scenario.h3("transfer (10 txs)")
+            c.transfer([
+                c.batch_transfer.item(from_ = alice.address,
+                                      txs = [sp.record(to_ = bob.address, amount = 1, token_id = tok)
+                                             for tok in range(1, 11)])
+            ]).run(sender = alice)
+            scenario.verify(c.data.ledger[c.ledger_key.make(bob.address, 10)] == 1)
+            # Nothing is emitted for an empty batch: no overhead.
+            scenario.h3("transfer (empty batch)")
+            c.transfer([]).run(sender = alice)
+
+## The instrumented build counts, for each call, the big-map accesses,
+## operator checks, set inserts and loop steps; the report shows the
+## counters after each call, i.e. a cost profile per entry point.
+def add_instrumentation_report(config, is_default = True):
+    assert config.instrumented
+    @kraznik_test("instrumentation-" + config.name, is_default = is_default)
+    def test():
+        scenario = test_scenario()
+        scenario.h1("Operation counters per entry point")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+        op1   = sp.test_account("Operator1")
+        c1 = originate_benchmark_contract(scenario, config, admin)
+        consumer = View_consumer(c1)
+        scenario += consumer
+
+        def profile(title, call):
+            scenario.h2(title)
+            c1.reset_counters().run(sender = admin)
+            call()
+            scenario.show(c1.data.counters)
+
+        profile("mint (2 tokens)", lambda:
+            c1.mint(purchase_quantity = 2).run(sender = alice, amount = sp.tez(138)))
+        profile("mint (1 token)", lambda:
+            c1.mint(purchase_quantity = 1).run(sender = bob, amount = sp.tez(69)))
+        profile("update_token_metadata (3 tokens)", lambda:
+            c1.update_token_metadata(metadata = sp.list(l = [
+                sp.record(token_id = tok, token_info = sp.map({"" : sp.utils.bytes_of_string("ipfs//::")}))
+                for tok in range(3)
+            ])).run(sender = admin))
+        profile("transfer (1 tx, new recipient)", lambda:
+            c1.transfer([
+                c1.batch_transfer.item(from_ = alice.address,
+                                       txs = [sp.record(to_ = bob.address, amount = 1, token_id = 0)])
+            ]).run(sender = alice))
+        profile("transfer (2 txs, 2 senders)", lambda:
+            c1.transfer([
+                c1.batch_transfer.item(from_ = alice.address,
+                                       txs = [sp.record(to_ = bob.address, amount = 1, token_id = 1)]),
+                c1.batch_transfer.item(from_ = bob.address,
+                                       txs = [sp.record(to_ = alice.address, amount = 1, token_id = 2)])
+            ]).run(sender = admin))
+        if config.support_operator:
+            profile("update_operators (1 add)", lambda:
+                c1.update_operators([
+                    sp.variant("add_operator", c1.operator_param.make(
+                        owner = bob.address, operator = op1.address, token_id = 0))
+                ]).run(sender = bob))
+            profile("transfer (as operator)", lambda:
+                c1.transfer([
+                    c1.batch_transfer.item(from_ = bob.address,
+                                           txs = [sp.record(to_ = op1.address, amount = 1, token_id = 0)])
+                ]).run(sender = op1))
+        profile("balance_of (4 requests, 1 duplicate)", lambda:
+            c1.balance_of(sp.record(
+                callback = sp.contract(
+                    Balance_of.response_type(),
+                    consumer.address,
+                    entry_point = "receive_balances").open_some(),
+                requests = [sp.record(owner = alice.address, token_id = 0),
+                            sp.record(owner = bob.address, token_id = 1),
+                            sp.record(owner = alice.address, token_id = 0),
+                            sp.record(owner = alice.address, token_id = 2)])).run(sender = alice))
+
+        # Alice is whitelisted for the presale; nobody can mint through it
+        # before the administrator opens it, and Bob never can.
+        scenario.h2("Presale")
+        c1.add_presale_address(owner = alice.address).run(sender = admin)
+        c1.presale_mint(purchase_quantity = 1).run(
+            sender = alice, amount = sp.tez(69), valid = False, exception = "Kraznik_PRESALE_INACTIVE")
+        c1.activate_presale().run(sender = alice, valid = False, exception = "FA2_NOT_ADMIN")
+        c1.activate_presale().run(sender = admin)
+        c1.presale_mint(purchase_quantity = 1).run(
+            sender = bob, amount = sp.tez(69), valid = False, exception = "Kraznik_NOT_AUTHORISED_FOR_PRESALE")
+        profile("presale_mint (2 tokens)", lambda:
+            c1.presale_mint(purchase_quantity = 2).run(sender = alice, amount = sp.tez(138)))
+        scenario.verify(c1.data.counters.set_inserts == 2)
+        scenario.verify(c1.data.ledger[c1.ledger_key.make(alice.address, 4)] == 1)
+        scenario.verify(c1.data.presale_map[alice.address] == 0)
+        c1.presale_mint(purchase_quantity = 1).run(
+            sender = alice, amount = sp.tez(69), valid = False,
+            exception = "Kraznik_CANT_PURCHASE_MORE_THAN_MAX_PURCHASE_ALLOWED")
+
 ##
 ## ## Global Environment Parameters
 ##
@@ -908,8 +1818,18 @@ def environment_config():
         lazy_entry_points = global_parameter("lazy_entry_points", False),
         allow_self_transfer = global_parameter("allow_self_transfer", False),
         use_token_metadata_offchain_view = global_parameter("use_token_metadata_offchain_view", True),
+        instrumented = global_parameter("instrumented", False),
+        add_marketplace = global_parameter("add_marketplace", False),
+        support_permits = global_parameter("support_permits", False),
+        add_onchain_views = global_parameter("add_onchain_views", False),
+        emit_events = global_parameter("emit_events", True),
     )
 
+build_profile = Build_profile(enabled = global_parameter("profile_build", False))
+only_test = os.environ.get("only_test")
+list_tests = global_parameter("list_tests", False)
+headless = global_parameter("headless", False)
+
 ## ## Standard “main”
 ##
 ## This specific main uses the relative new feature of non-default tests
@@ -934,6 +1854,18 @@ if "templates" not in __name__:
                  , is_default = not sp.in_browser)
         add_test(FA2_config(lazy_entry_points = True)
                  , is_default = not sp.in_browser)
+        add_balance_of_benchmark(environment_config(), is_default = not sp.in_browser)
+        add_balance_of_benchmark(FA2_config(assume_consecutive_token_ids = False),
+                                 is_default = not sp.in_browser)
+        add_instrumentation_report(FA2_config(instrumented = True),
+                                   is_default = not sp.in_browser)
+        add_marketplace_benchmark(FA2_config(add_marketplace = True),
+                                  is_default = not sp.in_browser)
+        add_permit_benchmark(FA2_config(support_permits = True),
+                             is_default = not sp.in_browser)
+        add_onchain_view_benchmark(FA2_config(add_onchain_views = True),
+                                   is_default = not sp.in_browser)
+        add_event_benchmark(is_default = not sp.in_browser)
 
     sp.add_compilation_target("FA2_comp", Kraznik(config = environment_config(),
                               metadata = sp.utils.metadata_of_url("https://example.com"),
@@ -0,0 +1,100 @@
+## Decoder for the contract events emitted by `Kraznik`.
+##
+## Each call emits at most one event per tag (see the `Event` class of
+## `KraznikCollections.py`); this module turns them back into Python values:
+##
+## - `transfer`: `[{"from_": ..., "txs": [{"to_", "token_id", "amount"}]}]`,
+## - `mint`: `{"owner": ..., "token_id": <first id>, "count": ...}`,
+## - `operators`: `[{"add_operator" | "remove_operator": {"owner", "operator", "token_id"}}]`,
+## - `token_metadata`: `[token_id, ...]`.
+##
+## `events_of_block` decodes the events of a block as returned by the RPC,
+## `stream` follows the chain and yields them once their block is final,
+## `FINALITY` levels below the head (Tenderbake): a block that could still
+## be replaced by a reorganisation is never read, so every event yielded
+## happened, exactly once:
+##
+##     python tezos/tools/kraznik_events.py --rpc http://localhost:8732 --contract KT1...
+##
+## prints one JSON object per event.
+import argparse
+import collections
+import json
+import time
+import urllib.request
+
+from micheline import comb, decode_address, decode_transfer, decode_update_operators
+
+Event = collections.namedtuple("Event", ["level", "operation", "tag", "data"])
+
+def decode_mint(payload):
+    (owner, token_id, count) = comb(payload, 3)
+    return {"owner": decode_address(owner),
+            "token_id": int(token_id["int"]),
+            "count": int(count["int"])}
+
+def decode_token_metadata(payload):
+    return [int(token_id["int"]) for token_id in payload]
+
+DECODERS = {
+    "transfer": decode_transfer,
+    "mint": decode_mint,
+    "operators": decode_update_operators,
+    "token_metadata": decode_token_metadata,
+}
+
+def decode(tag, payload):
+    if tag not in DECODERS:
+        raise ValueError("Unknown Kraznik event tag: %s" % tag)
+    return DECODERS[tag](payload)
+
+def events_of_block(block, contract):
+    """The applied events of `contract` in `block` (the JSON of
+    `/chains/main/blocks/<id>`), in the order they were emitted."""
+    level = block["header"]["level"]
+    events = []
+    for group in block["operations"][3]:
+        for content in group["contents"]:
+            results = content.get("metadata", {}).get("internal_operation_results", [])
+            for result in results:
+                if (result.get("kind") == "event" and result.get("source") == contract
+                        and result.get("result", {}).get("status") == "applied"):
+                    tag = result.get("tag")
+                    events.append(Event(level, group["hash"], tag, decode(tag, result["payload"])))
+    return events
+
+## As `Rpc_node.FINALITY` in `kraznik_gateway.py`.
+FINALITY = 2
+
+def rpc_getter(rpc):
+    def get(path):
+        with urllib.request.urlopen(rpc.rstrip("/") + path) as response:
+            return json.load(response)
+    return get
+
+def stream(get, contract, chain = "main", interval = 2.0, start = None):
+    """Yields the events of `contract` from level `start` (by default, the
+    next final block) onwards, forever; `get` answers the JSON of an RPC
+    path (see `rpc_getter`)."""
+    def last_final():
+        return get("/chains/%s/blocks/head/header" % chain)["level"] - FINALITY
+    level = start if start is not None else last_final() + 1
+    while True:
+        final = last_final()
+        while level <= final:
+            for event in events_of_block(get("/chains/%s/blocks/%d" % (chain, level)), contract):
+                yield event
+            level += 1
+        time.sleep(interval)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Decode the events of a Kraznik contract.")
+    parser.add_argument("--rpc", required = True, help = "URL of the node RPC")
+    parser.add_argument("--contract", required = True, help = "address of the Kraznik contract")
+    parser.add_argument("--from-level", type = int, help = "first level to decode")
+    options = parser.parse_args(argv)
+    for event in stream(rpc_getter(options.rpc), options.contract, start = options.from_level):
+        print(json.dumps(event._asdict()), flush = True)
+
+if __name__ == "__main__":
+    main()
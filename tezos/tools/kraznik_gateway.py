@@ -0,0 +1,611 @@
+## Read-through caching gateway for `Kraznik` storage.
+##
+## The web app and the backend used to read `ledger`, `token_metadata` and
+## the offchain views from the node on every render. The gateway answers
+## the same questions from an in-process LRU cache, keyed by big-map key,
+## and only goes to the node on a miss:
+##
+## - `get_balance(owner, token_id)`,
+## - `count_tokens()` and `all_tokens()`,
+## - `is_operator(owner, operator, token_id)`,
+## - `token_metadata(token_id)`.
+##
+## Entries are invalidated from the stream of applied operations that
+## target the contract: `transfer` drops the ledger keys it touched, `mint`
+## the minter's keys and the token set, `update_operators` the operator
+## keys, `update_token_metadata` the metadata of the updated tokens, `buy`
+## the ledger keys of the sold token; `permit_transfer` is a `transfer`.
+## Operations the gateway does not know about flush the whole cache, and so
+## do a reorganisation that replaces a block already processed and a sync
+## that fails (the node could not be reached, an operation could not be
+## decoded...); the blocks of a failed sync are read again by the next one.
+##
+## As in the contract, a token exists once it has been minted:
+## `get_balance` fails with `FA2_TOKEN_UNDEFINED` for tokens that are not in
+## `all_tokens`, whether or not they have metadata.
+##
+## Two node back-ends share one interface (`big_map_get`, `storage_field`
+## and `new_operations`):
+## - `Rpc_node` talks to an octez node over its RPC,
+## - `Recorded_node` replays recorded storage and blocks from a JSON file,
+##   for tests and local runs without a node.
+##
+## Usage:
+##
+##     python tezos/tools/kraznik_gateway.py --rpc http://localhost:8732 \
+##         --contract KT1... --port 8080
+##     python tezos/tools/kraznik_gateway.py --recorded recording.json \
+##         --replay-blocks --port 8080
+##
+## With `--replay-blocks`, every sync first applies the next recorded block,
+## as if the node had baked it; see `testdata/kraznik_recording.json`.
+##
+## HTTP endpoints take their arguments as query parameters
+## (`/get_balance?owner=tz1...&token_id=0`) and answer JSON;
+## `/metrics` answers hit-rate and latency metrics in the Prometheus text
+## format.
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from micheline import base58check, binary, comb, decode_transfer, decode_update_operators
+
+class Gateway_error(Exception):
+    pass
+
+## ## Caching
+
+class Lru_cache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns `(True, value)` on a hit and `(False, None)` otherwise."""
+        if key not in self.entries:
+            return (False, None)
+        self.entries.move_to_end(key)
+        return (True, self.entries[key])
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        for key in [k for k in self.entries if predicate(k)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+class Metrics:
+    def __init__(self):
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.latency = collections.Counter()
+        self.latency_max = collections.Counter()
+        self.invalidations = collections.Counter()
+
+    def record(self, method, hit, seconds):
+        if hit:
+            self.hits[method] += 1
+        else:
+            self.misses[method] += 1
+        self.latency[method] += seconds
+        self.latency_max[method] = max(self.latency_max[method], seconds)
+
+    def hit_rate(self, method = None):
+        if method is None:
+            (hits, misses) = (sum(self.hits.values()), sum(self.misses.values()))
+        else:
+            (hits, misses) = (self.hits[method], self.misses[method])
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def to_dict(self):
+        methods = sorted(set(self.hits) | set(self.misses))
+        return {
+            "hit_rate": self.hit_rate(),
+            "invalidations": dict(self.invalidations),
+            "methods": dict([(m, {
+                "hits": self.hits[m],
+                "misses": self.misses[m],
+                "hit_rate": self.hit_rate(m),
+                "latency_avg_ms": 1000 * self.latency[m] / (self.hits[m] + self.misses[m]),
+                "latency_max_ms": 1000 * self.latency_max[m],
+            }) for m in methods]),
+        }
+
+    def to_prometheus(self):
+        lines = []
+        for m in sorted(set(self.hits) | set(self.misses)):
+            lines.append('kraznik_gateway_hits_total{method="%s"} %d' % (m, self.hits[m]))
+            lines.append('kraznik_gateway_misses_total{method="%s"} %d' % (m, self.misses[m]))
+            lines.append('kraznik_gateway_latency_seconds_sum{method="%s"} %f' % (m, self.latency[m]))
+            lines.append('kraznik_gateway_latency_seconds_max{method="%s"} %f' % (m, self.latency_max[m]))
+        for (kind, n) in sorted(self.invalidations.items()):
+            lines.append('kraznik_gateway_invalidations_total{kind="%s"} %d' % (kind, n))
+        lines.append("kraznik_gateway_hit_rate %f" % self.hit_rate())
+        return "\n".join(lines) + "\n"
+
+## ## Gateway
+
+## Entry points known not to change anything the gateway caches.
+HARMLESS_ENTRY_POINTS = {
+    "balance_of", "set_pause", "set_administrator", "set_metadata",
+    "withdraw", "add_presale_address", "remove_presale_address",
+    "activate_presale", "transfer_mutez", "reset_counters",
+    "list_token", "cancel_listing",
+}
+
+class Kraznik_gateway:
+    def __init__(self, node, capacity = 100000):
+        self.node = node
+        self.cache = Lru_cache(capacity)
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        # Bumped by every `sync` that invalidates something, so that a value
+        # loaded before an invalidation is not cached after it.
+        self.generation = 0
+        self.invalidators = {
+            "transfer": self.invalidate_transfer,
+            "mint": self.invalidate_mint,
+            "presale_mint": self.invalidate_mint,
+            "update_operators": self.invalidate_operators,
+            "update_token_metadata": self.invalidate_token_metadata,
+            "buy": self.invalidate_buy,
+            "permit_transfer": self.invalidate_permit_transfer,
+        }
+
+    ## Lookups return `(hit, value)` and record no metrics: each public
+    ## method below records one call under its own name, which is a hit
+    ## when none of its lookups had to go to the node.
+
+    def lookup(self, key, load):
+        with self.lock:
+            (hit, value) = self.cache.get(key)
+            generation = self.generation
+        if not hit:
+            value = load()
+            with self.lock:
+                if generation == self.generation:
+                    self.cache.put(key, value)
+        return (hit, value)
+
+    def big_map_lookup(self, big_map, key):
+        return self.lookup((big_map,) + key, lambda: self.node.big_map_get(big_map, key))
+
+    def tokens_lookup(self):
+        return self.lookup(("storage", "all_tokens"),
+                           lambda: frozenset(self.node.storage_field("all_tokens")))
+
+    def measure(self, method, start, *hits):
+        self.metrics.record(method, all(hits), time.perf_counter() - start)
+
+    def token_metadata(self, token_id):
+        start = time.perf_counter()
+        (hit, metadata) = self.big_map_lookup("token_metadata", (token_id,))
+        self.measure("token_metadata", start, hit)
+        if metadata is None:
+            raise Gateway_error("FA2_TOKEN_UNDEFINED")
+        return metadata
+
+    def get_balance(self, owner, token_id):
+        start = time.perf_counter()
+        (tokens_hit, tokens) = self.tokens_lookup()
+        if token_id not in tokens:
+            self.measure("get_balance", start, tokens_hit)
+            raise Gateway_error("FA2_TOKEN_UNDEFINED")
+        (hit, balance) = self.big_map_lookup("ledger", (owner, token_id))
+        self.measure("get_balance", start, tokens_hit, hit)
+        return balance or 0
+
+    def is_operator(self, owner, operator, token_id):
+        start = time.perf_counter()
+        (hit, value) = self.big_map_lookup("operators", (owner, operator, token_id))
+        self.measure("is_operator", start, hit)
+        return value is not None
+
+    def all_tokens(self):
+        start = time.perf_counter()
+        (hit, tokens) = self.tokens_lookup()
+        self.measure("all_tokens", start, hit)
+        return sorted(tokens)
+
+    def count_tokens(self):
+        start = time.perf_counter()
+        (hit, tokens) = self.tokens_lookup()
+        self.measure("count_tokens", start, hit)
+        return len(tokens)
+
+    ## Invalidation
+
+    def sync(self):
+        """Invalidates the entries affected by the operations applied
+        since the last call; returns how many operations were seen."""
+        operations = self.node.new_operations()
+        with self.lock:
+            if operations:
+                self.generation += 1
+            for operation in operations:
+                self.apply(operation)
+        return len(operations)
+
+    def apply(self, operation):
+        if operation.get("reorg"):
+            self.metrics.invalidations["reorg"] += 1
+            self.cache.clear()
+            return
+        entry_point = operation["entrypoint"]
+        if entry_point in self.invalidators:
+            self.invalidators[entry_point](operation)
+        elif entry_point not in HARMLESS_ENTRY_POINTS:
+            self.metrics.invalidations["flush"] += 1
+            self.cache.clear()
+
+    def invalidate(self, key):
+        self.metrics.invalidations[key[0]] += 1
+        self.cache.invalidate(key)
+
+    def invalidate_transfer(self, operation):
+        for transfer in operation["parameters"]:
+            for tx in transfer["txs"]:
+                self.invalidate(("ledger", transfer["from_"], tx["token_id"]))
+                self.invalidate(("ledger", tx["to_"], tx["token_id"]))
+
+    def invalidate_mint(self, operation):
+        sender = operation["sender"]
+        self.metrics.invalidations["mint"] += 1
+        self.cache.invalidate(("storage", "all_tokens"))
+        self.cache.invalidate_where(lambda k: k[0] == "ledger" and k[1] == sender)
+
+    def invalidate_permit_transfer(self, operation):
+        self.invalidate_transfer({"parameters": [p["transfer"] for p in operation["parameters"]]})
+
+    def invalidate_buy(self, operation):
+        # The seller is in the listing, not in the parameters.
+        token_id = operation["parameters"]
+        self.metrics.invalidations["buy"] += 1
+        self.cache.invalidate_where(lambda k: k[0] == "ledger" and k[2] == token_id)
+
+    def invalidate_operators(self, operation):
+        for update in operation["parameters"]:
+            p = update.get("add_operator") or update.get("remove_operator")
+            self.invalidate(("operators", p["owner"], p["operator"], p["token_id"]))
+
+    def invalidate_token_metadata(self, operation):
+        for metadata in operation["parameters"]:
+            self.invalidate(("token_metadata", metadata["token_id"]))
+
+    def flush(self, kind):
+        with self.lock:
+            self.generation += 1
+            self.metrics.invalidations[kind] += 1
+            self.cache.clear()
+
+    def try_sync(self):
+        """`sync`, for the background loop: a failure is logged and flushes
+        the cache, since the operations it was about to apply are unknown.
+        Returns the number of operations seen, or `None` on failure."""
+        try:
+            return self.sync()
+        except Exception:
+            print("sync failed:")
+            traceback.print_exc()
+            self.flush("sync_error")
+            return None
+
+    def run_sync(self, interval):
+        def loop():
+            while True:
+                self.try_sync()
+                time.sleep(interval)
+        thread = threading.Thread(target = loop, daemon = True)
+        thread.start()
+        return thread
+
+## ## Recorded node
+##
+## The recording is a JSON object:
+##
+##     {"storage": {"all_tokens": [0, 1]},
+##      "big_maps": {"ledger": [[["tz1...", 0], 1]],
+##                   "token_metadata": [[[0], {"token_id": 0, "token_info": {}}]],
+##                   "operators": [[["tz1...", "tz1...", 0], null]]},
+##      "blocks": [{"operations": [...], "big_map_diffs": {...}, "storage": {...}}]}
+##
+## Keys are lists of the same components the gateway uses for its cache;
+## operator values are `null` (`Unit`). `next_block` applies the next
+## recorded block (`big_map_diffs` sets keys, `removed` lists the keys it
+## deletes) and queues its operations for `new_operations`; with `advance`,
+## `new_operations` calls it first, so that each sync sees one new block.
+class Recorded_node:
+    def __init__(self, recording, latency = 0.0, advance = False):
+        self.storage = dict(recording.get("storage", {}))
+        self.big_maps = dict([
+            (name, dict([(tuple(k), v) for (k, v) in entries]))
+            for (name, entries) in recording.get("big_maps", {}).items()])
+        self.blocks = list(recording.get("blocks", []))
+        self.pending = []
+        self.latency = latency
+        self.advance = advance
+        self.requests = 0
+
+    def load(path, latency = 0.0, advance = False):
+        with open(path) as f:
+            return Recorded_node(json.load(f), latency = latency, advance = advance)
+
+    def read(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def big_map_get(self, name, key):
+        self.read()
+        if tuple(key) not in self.big_maps.get(name, {}):
+            return None
+        # Operators are a lazy set: present keys map to `Unit`.
+        value = self.big_maps[name][tuple(key)]
+        return True if value is None else value
+
+    def storage_field(self, name):
+        self.read()
+        return self.storage[name]
+
+    def next_block(self):
+        if not self.blocks:
+            return False
+        block = self.blocks.pop(0)
+        for (name, entries) in block.get("big_map_diffs", {}).items():
+            big_map = self.big_maps.setdefault(name, {})
+            for (k, v) in entries:
+                big_map[tuple(k)] = v
+        for (name, entries) in block.get("removed", {}).items():
+            for k in entries:
+                self.big_maps.get(name, {}).pop(tuple(k), None)
+        self.storage.update(block.get("storage", {}))
+        self.pending.extend(block.get("operations", []))
+        return True
+
+    def new_operations(self):
+        if self.advance:
+            self.next_block()
+        (operations, self.pending) = (self.pending, [])
+        return operations
+
+## ## RPC node
+
+def decode_update_token_metadata(parameters):
+    return [{"token_id": int(comb(m, 2)[0]["int"])} for m in parameters]
+
+def decode_permit_transfer(parameters):
+    return [{"transfer": decode_transfer([comb(p, 3)[2]])[0]} for p in parameters]
+
+DECODERS = {
+    "permit_transfer": decode_permit_transfer,
+    "buy": lambda value: int(value["int"]),
+    "transfer": decode_transfer,
+    "update_operators": decode_update_operators,
+    "update_token_metadata": decode_update_token_metadata,
+}
+
+class Rpc_node:
+    # Tenderbake blocks are final two levels below the head, so only the
+    # hashes of the last processed levels are needed to notice that a
+    # reorganisation replaced one of them.
+    FINALITY = 2
+
+    def __init__(self, url, contract, chain = "main"):
+        self.url = url.rstrip("/")
+        self.contract = contract
+        self.chain = chain
+        self.hashes = {}
+        self.big_map_ids = None
+        self.requests = 0
+
+    def rpc(self, path, body = None):
+        self.requests += 1
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(
+            self.url + path, data = data,
+            headers = {"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def head(self, suffix = ""):
+        return "/chains/%s/blocks/head%s" % (self.chain, suffix)
+
+    def storage_fields(self):
+        """Maps each annotated storage field to its Micheline value, by
+        walking the storage type and value together."""
+        script = self.rpc(self.head("/context/contracts/%s/script" % self.contract))
+        storage_type = [s for s in script["code"] if s["prim"] == "storage"][0]["args"][0]
+        storage = self.rpc(self.head("/context/contracts/%s/storage/normalized" % self.contract),
+                           {"unparsing_mode": "Readable"})
+        fields = {}
+        def walk(t, v):
+            for annot in t.get("annots", []):
+                if annot.startswith("%"):
+                    fields[annot[1:]] = v
+            if t["prim"] == "pair":
+                for (ti, vi) in zip(binary(t, "pair"), binary(v)):
+                    walk(ti, vi)
+        walk(storage_type, storage)
+        return fields
+
+    def storage_field(self, name):
+        value = self.storage_fields()[name]
+        if name == "all_tokens":
+            return [int(v["int"]) for v in value]
+        raise Gateway_error("Unsupported storage field: " + name)
+
+    KEY_TYPES = {
+        "ledger": {"prim": "pair", "args": [{"prim": "address"}, {"prim": "nat"}]},
+        "token_metadata": {"prim": "nat"},
+        "operators": {"prim": "pair", "args": [{"prim": "address"},
+                      {"prim": "pair", "args": [{"prim": "address"}, {"prim": "nat"}]}]},
+    }
+
+    # Only the `readable` layout of the operator set is supported: with
+    # `readable = False` its keys are packed records.
+    def micheline_key(self, name, key):
+        if name == "token_metadata":
+            return {"int": str(key[0])}
+        items = [{"string": k} for k in key[:-1]] + [{"int": str(key[-1])}]
+        node = items[-1]
+        for item in reversed(items[:-1]):
+            node = {"prim": "Pair", "args": [item, node]}
+        return node
+
+    def big_map_get(self, name, key):
+        if self.big_map_ids is None:
+            fields = self.storage_fields()
+            self.big_map_ids = dict([(n, int(fields[n]["int"])) for n in self.KEY_TYPES])
+        packed = self.rpc(self.head("/helpers/scripts/pack_data"),
+                          {"data": self.micheline_key(name, key), "type": self.KEY_TYPES[name]})
+        digest = hashlib.blake2b(bytes.fromhex(packed["packed"]), digest_size = 32).digest()
+        expr = base58check(bytes([13, 44, 64, 27]), digest)
+        value = self.rpc(self.head("/context/big_maps/%d/%s" % (self.big_map_ids[name], expr)))
+        if value is None:
+            return None
+        if name == "ledger":
+            return int(value["int"])
+        if name == "operators":
+            return True
+        (token_id, token_info) = comb(value, 2)
+        return {"token_id": int(token_id["int"]),
+                "token_info": dict([(e["args"][0]["string"], e["args"][1]["bytes"]) for e in token_info])}
+
+    def block(self, block_id, suffix):
+        return self.rpc("/chains/%s/blocks/%s%s" % (self.chain, block_id, suffix))
+
+    def new_operations(self):
+        """The calls to the contract in the blocks applied since the last
+        call, oldest first, preceded by `{"reorg": True}` if a block that
+        was already processed has been replaced."""
+        head = self.rpc(self.head("/header"))
+        if not self.hashes:
+            self.hashes = {head["level"]: head["hash"]}
+            return []
+        # Walk back from the head, following predecessors, to the last
+        # processed block that is still on the chain.
+        oldest = min(self.hashes)
+        new_blocks = []
+        header = head
+        reorg = False
+        while self.hashes.get(header["level"]) != header["hash"]:
+            if header["level"] < oldest:
+                reorg = True
+                break
+            reorg = reorg or header["level"] in self.hashes
+            new_blocks.append(header)
+            header = self.block(header["predecessor"], "/header")
+        operations = [{"reorg": True}] if reorg else []
+        for header in reversed(new_blocks):
+            for group in self.block(header["hash"], "/operations/3"):
+                for content in group["contents"]:
+                    operations.extend(self.contract_calls(content))
+        # Only once every new block has been read and decoded: if anything
+        # fails before, the next call starts again from the same blocks.
+        for header in new_blocks:
+            self.hashes[header["level"]] = header["hash"]
+        self.hashes = dict([(l, h) for (l, h) in self.hashes.items()
+                            if head["level"] - self.FINALITY <= l <= head["level"]])
+        return operations
+
+    def contract_calls(self, content):
+        """Applied calls to the contract in a manager operation, including
+        the internal ones (e.g. a marketplace calling `transfer`)."""
+        result = content.get("metadata", {})
+        candidates = [(content, result.get("operation_result", {}))]
+        candidates += [(i, i.get("result", {})) for i in result.get("internal_operation_results", [])]
+        calls = []
+        for (op, op_result) in candidates:
+            if (op.get("kind") != "transaction" or op.get("destination") != self.contract
+                    or op_result.get("status") != "applied"):
+                continue
+            parameters = op.get("parameters", {"entrypoint": "default", "value": None})
+            entry_point = parameters["entrypoint"]
+            decode = DECODERS.get(entry_point, lambda v: v)
+            calls.append({"entrypoint": entry_point, "sender": op["source"],
+                          "parameters": decode(parameters["value"])})
+        return calls
+
+## ## HTTP front-end
+
+def make_handler(gateway):
+    endpoints = {
+        "/get_balance": lambda q: gateway.get_balance(q["owner"], int(q["token_id"])),
+        "/count_tokens": lambda q: gateway.count_tokens(),
+        "/all_tokens": lambda q: gateway.all_tokens(),
+        "/is_operator": lambda q: gateway.is_operator(q["owner"], q["operator"], int(q["token_id"])),
+        "/token_metadata": lambda q: gateway.token_metadata(int(q["token_id"])),
+    }
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code, body, content_type = "application/json"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == "/metrics":
+                return self.reply(200, gateway.metrics.to_prometheus(), "text/plain")
+            if url.path not in endpoints:
+                return self.reply(404, json.dumps({"error": "unknown endpoint"}))
+            try:
+                self.reply(200, json.dumps(endpoints[url.path](query)))
+            except (KeyError, ValueError) as e:
+                self.reply(400, json.dumps({"error": "bad request: %s" % e}))
+            except Gateway_error as e:
+                self.reply(404, json.dumps({"error": str(e)}))
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Caching gateway for Kraznik storage.")
+    parser.add_argument("--rpc", help = "URL of the node RPC")
+    parser.add_argument("--contract", help = "address of the Kraznik contract")
+    parser.add_argument("--recorded", help = "replay a recording (JSON) instead of a node")
+    parser.add_argument("--replay-blocks", action = "store_true",
+                        help = "with --recorded, apply one recorded block at each sync")
+    parser.add_argument("--capacity", type = int, default = 100000, help = "cache entries")
+    parser.add_argument("--sync-interval", type = float, default = 5.0,
+                        help = "seconds between two reads of the operation stream")
+    parser.add_argument("--port", type = int, default = 8080)
+    options = parser.parse_args(argv)
+    if options.recorded:
+        node = Recorded_node.load(options.recorded, advance = options.replay_blocks)
+    elif options.rpc and options.contract:
+        node = Rpc_node(options.rpc, options.contract)
+    else:
+        parser.error("either --recorded or both --rpc and --contract are required")
+    gateway = Kraznik_gateway(node, capacity = options.capacity)
+    gateway.run_sync(options.sync_interval)
+    server = http.server.ThreadingHTTPServer(("", options.port), make_handler(gateway))
+    print("Serving on port %d" % options.port)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+## Size-budgeted TZIP-016 metadata.
+##
+## SmartPy writes the contract metadata, with the compiled code of every
+## offchain view, next to the compiled contract
+## (`step_000_cont_0_metadata.metadata_base.json`). That is the document we
+## pin and that wallets fetch and parse before they can call any view, so
+## this tool shrinks it before it is published:
+##
+## - top-level fields that are not part of TZIP-016 (or the TZIP-012
+##   `permissions`) are dropped, as are the ones listed with `--drop`,
+## - view descriptions and the `annotations` of storage views are dropped
+##   unless `--keep-descriptions` is given,
+## - variable annotations (`@x`) are stripped from view code; they are
+##   comments for the type-checker and do not change the semantics,
+## - the JSON is written without any whitespace.
+##
+## TZIP-016 has no way for views to share code, so the Michelson that views
+## have in common (typically the storage accessors at their start) is
+## reported rather than factored out; identical views are reported too.
+##
+## With `--budget`, the tool fails, without writing `--output`, if the
+## output is larger than the given number of bytes, so that CI catches
+## metadata growth:
+##
+##     python tezos/tools/metadata_tool.py \
+##         FA2_comp/step_000_cont_0_metadata.metadata_base.json \
+##         --output metadata.min.json --budget 12000
+import argparse
+import json
+import sys
+
+import micheline
+
+TZIP16_FIELDS = [
+    "name", "description", "version", "license", "authors", "homepage",
+    "source", "interfaces", "errors", "views", "permissions",
+]
+
+def minified(document):
+    return json.dumps(document, separators = (",", ":"), ensure_ascii = False)
+
+def size(document):
+    return len(minified(document).encode())
+
+def strip_variable_annotations(node):
+    if isinstance(node, list):
+        return [strip_variable_annotations(n) for n in node]
+    if not isinstance(node, dict) or "prim" not in node:
+        return node
+    result = dict(node)
+    if "args" in node:
+        result["args"] = [strip_variable_annotations(a) for a in node["args"]]
+    annots = [a for a in node.get("annots", []) if not a.startswith("@")]
+    if annots:
+        result["annots"] = annots
+    else:
+        result.pop("annots", None)
+    return result
+
+def storage_views(view):
+    return [i["michelsonStorageView"] for i in view.get("implementations", [])
+            if "michelsonStorageView" in i]
+
+def shrink(document, drop = (), keep_descriptions = False):
+    result = dict([(k, v) for (k, v) in document.items()
+                   if k in TZIP16_FIELDS and k not in drop])
+    views = []
+    for view in result.get("views", []):
+        view = dict(view)
+        if not keep_descriptions:
+            view.pop("description", None)
+        implementations = []
+        for implementation in view.get("implementations", []):
+            if "michelsonStorageView" in implementation:
+                code = dict(implementation["michelsonStorageView"])
+                code["code"] = strip_variable_annotations(code["code"])
+                if not keep_descriptions:
+                    code.pop("annotations", None)
+                implementation = {"michelsonStorageView": code}
+            implementations.append(implementation)
+        view["implementations"] = implementations
+        views.append(view)
+    if views:
+        result["views"] = views
+    return result
+
+def common_prefix(a, b):
+    n = 0
+    while n < min(len(a), len(b)) and micheline.canonical(a[n]) == micheline.canonical(b[n]):
+        n += 1
+    return a[:n]
+
+def shared_code(views):
+    """Pairs of views whose code starts with the same instructions, with the
+    number of shared Micheline nodes, and pairs of views with identical
+    code."""
+    codes = []
+    for view in views:
+        for implementation in storage_views(view):
+            codes.append((view["name"], implementation["code"]))
+    shared = []
+    identical = []
+    for i in range(len(codes)):
+        for j in range(i + 1, len(codes)):
+            (a, b) = (codes[i], codes[j])
+            if micheline.canonical(a[1]) == micheline.canonical(b[1]):
+                identical.append((a[0], b[0]))
+            else:
+                prefix = common_prefix(a[1], b[1])
+                if prefix:
+                    shared.append((micheline.count_nodes(prefix) - 1, a[0], b[0]))
+    return (sorted(shared, reverse = True), identical)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Size-budgeted TZIP-016 metadata.")
+    parser.add_argument("metadata", help = "metadata JSON written by SmartPy")
+    parser.add_argument("--output", help = "where to write the minified metadata")
+    parser.add_argument("--drop", action = "append", default = [],
+                        help = "top-level field to drop (can be repeated)")
+    parser.add_argument("--keep-descriptions", action = "store_true",
+                        help = "keep view descriptions and annotations")
+    parser.add_argument("--budget", type = int, help = "maximum size of the output, in bytes")
+    options = parser.parse_args(argv)
+
+    with open(options.metadata) as f:
+        document = json.load(f)
+    shrunk = shrink(document, drop = options.drop, keep_descriptions = options.keep_descriptions)
+
+    total = size(shrunk)
+    print("metadata: %d -> %d bytes" % (size(document), total))
+    dropped = sorted(set(document) - set(shrunk))
+    if dropped:
+        print("dropped fields: " + ", ".join(dropped))
+    print("fetch size per view:")
+    for view in shrunk.get("views", []):
+        print("  %-28s %6d bytes" % (view["name"], size(view)))
+
+    (shared, identical) = shared_code(shrunk.get("views", []))
+    for (a, b) in identical:
+        print("views %s and %s have identical code" % (a, b))
+    if shared:
+        print("largest code prefixes shared between views (nodes):")
+        for (nodes, a, b) in shared[:5]:
+            print("  %4d  %s / %s" % (nodes, a, b))
+
+    if options.budget is not None and total > options.budget:
+        print("over budget: %d > %d bytes" % (total, options.budget))
+        return 1
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(minified(shrunk))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
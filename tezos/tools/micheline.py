@@ -0,0 +1,145 @@
+## Helpers for the Micheline JSON that SmartPy writes next to each compiled
+## contract (`step_000_cont_0_contract.json`) and that TZIP-16 metadata uses
+## for view code.
+##
+## A node is either a list (a sequence), a `{"int": ...}`, `{"string": ...}`
+## or `{"bytes": ...}` literal, or a primitive application
+## `{"prim": ..., "args": [...], "annots": [...]}`.
+##
+## The decoders of addresses, pairs and `Kraznik` parameters at the end of
+## this module are shared by the gateway and the event decoder.
+import hashlib
+import json
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def dump(node, path):
+    with open(path, "w") as f:
+        json.dump(node, f, separators = (",", ":"))
+
+def prim(node):
+    if isinstance(node, dict):
+        return node.get("prim")
+    return None
+
+def args(node):
+    if isinstance(node, dict):
+        return node.get("args", [])
+    return []
+
+def int_arg(node, default = None):
+    """The integer argument of `DROP n`, `DIG n`... or `default`."""
+    a = args(node)
+    if len(a) == 1 and isinstance(a[0], dict) and "int" in a[0]:
+        return int(a[0]["int"])
+    return default
+
+def make(name, *arguments, annots = None):
+    node = {"prim": name}
+    if arguments:
+        node["args"] = list(arguments)
+    if annots:
+        node["annots"] = list(annots)
+    return node
+
+def count_nodes(node):
+    if isinstance(node, list):
+        return 1 + sum(count_nodes(n) for n in node)
+    if isinstance(node, dict) and "prim" in node:
+        return 1 + sum(count_nodes(n) for n in args(node))
+    return 1
+
+def canonical(node):
+    """A hashable, order-preserving key for structural comparisons."""
+    return json.dumps(node, sort_keys = True, separators = (",", ":"))
+
+def _string_literal(s):
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def to_text(node, wrap = False):
+    """Prints `node` in compact Michelson concrete syntax."""
+    if isinstance(node, list):
+        return "{" + " ; ".join(to_text(n) for n in node) + "}"
+    if "int" in node:
+        return node["int"]
+    if "string" in node:
+        return _string_literal(node["string"])
+    if "bytes" in node:
+        return "0x" + node["bytes"]
+    words = [node["prim"]] + node.get("annots", []) + [to_text(a, wrap = True) for a in args(node)]
+    text = " ".join(words)
+    if wrap and len(words) > 1:
+        return "(" + text + ")"
+    return text
+
+def script_to_text(script):
+    """Prints a whole script (a sequence of `parameter`, `storage`, `code`
+    and `view` sections) the way `.tz` files are laid out."""
+    return "\n".join(to_text(section) + ";" for section in script) + "\n"
+
+## ## Values
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def base58check(prefix, payload):
+    data = prefix + payload
+    data += hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    n = int.from_bytes(data, "big")
+    out = ""
+    while n:
+        (n, r) = divmod(n, 58)
+        out = BASE58_ALPHABET[r] + out
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + out
+
+ADDRESS_PREFIXES = {
+    0: bytes([6, 161, 159]),  # tz1
+    1: bytes([6, 161, 161]),  # tz2
+    2: bytes([6, 161, 164]),  # tz3
+}
+
+def decode_address(node):
+    """Micheline address, in readable (`string`) or optimized (`bytes`) form."""
+    if "string" in node:
+        return node["string"]
+    raw = bytes.fromhex(node["bytes"])
+    if raw[0] == 0:
+        return base58check(ADDRESS_PREFIXES[raw[1]], raw[2:22])
+    return base58check(bytes([2, 90, 121]), raw[1:21])  # KT1
+
+def binary(node, pair_prim = "Pair"):
+    """The two sides of a pair value (or `pair` type), whether written
+    `Pair a (Pair b c)`, `Pair a b c` or `{a; b; c}`."""
+    items = node if isinstance(node, list) else node["args"]
+    if len(items) == 2:
+        return items
+    rest = items[1:]
+    return (items[0], rest if isinstance(node, list) else {"prim": pair_prim, "args": rest})
+
+def comb(node, n):
+    """The `n` components of a right comb."""
+    if n == 1:
+        return [node]
+    (a, b) = binary(node)
+    return [a] + comb(b, n - 1)
+
+def decode_transfer(parameters):
+    result = []
+    for transfer in parameters:
+        (from_, txs) = comb(transfer, 2)
+        result.append({"from_": decode_address(from_), "txs": [
+            dict(zip(["to_", "token_id", "amount"],
+                     [decode_address(p[0]), int(p[1]["int"]), int(p[2]["int"])]))
+            for p in [comb(tx, 3) for tx in txs]]})
+    return result
+
+def decode_update_operators(parameters):
+    result = []
+    for update in parameters:
+        (owner, operator, token_id) = comb(update["args"][0], 3)
+        kind = "add_operator" if update["prim"] == "Left" else "remove_operator"
+        result.append({kind: {"owner": decode_address(owner),
+                              "operator": decode_address(operator),
+                              "token_id": int(token_id["int"])}})
+    return result
@@ -0,0 +1,262 @@
+## Peephole optimization of compiled Michelson.
+##
+## SmartPy's output for `Kraznik` keeps stack shuffles and dead pushes
+## behind, mostly where inherited entry points and inlined helpers meet.
+## This pass rewrites the Micheline JSON of a compiled contract with local
+## rules that each preserve the semantics of the sequence they rewrite:
+## they never change what is left on the stack, what can fail, or which
+## operations are emitted.
+##
+## Usage:
+##
+##     python tezos/tools/michelson_peephole.py \
+##         FA2_comp/step_000_cont_0_contract.json \
+##         --output FA2_comp/contract.optimized.json \
+##         --tz FA2_comp/contract.optimized.tz
+##
+## With `--octez-client`, both versions are type-checked in mockup mode
+## (no node or network needed) before anything is reported as a win.
+##
+## Repeated subsequences that could be shared through a `LAMBDA`/`EXEC`
+## pair are only reported: sharing code trades storage for gas at every
+## call, which is a decision to make by hand.
+import argparse
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+
+import micheline
+from micheline import args, canonical, int_arg, make, prim
+
+## Positions of the code (as opposed to type or data) arguments of each
+## primitive; only those are rewritten.
+CODE_ARGS = {
+    "IF": [0, 1], "IF_NONE": [0, 1], "IF_LEFT": [0, 1], "IF_CONS": [0, 1],
+    "DIP": [-1], "ITER": [0], "MAP": [0], "LOOP": [0], "LOOP_LEFT": [0],
+    "LAMBDA": [2], "LAMBDA_REC": [2], "code": [0], "view": [3],
+}
+
+## Instructions that push exactly one value, consume nothing, and cannot
+## fail: followed by `DROP`, they can be removed.
+PURE_PUSHES = {
+    "PUSH", "UNIT", "NIL", "NONE", "EMPTY_SET", "EMPTY_MAP",
+    "EMPTY_BIG_MAP", "AMOUNT", "BALANCE", "NOW", "SENDER", "SOURCE",
+    "SELF_ADDRESS", "CHAIN_ID", "LEVEL", "DUP", "LAMBDA",
+}
+
+## Binary instructions whose two arguments can be swapped for every type
+## combination Michelson accepts.
+COMMUTATIVE = {"ADD", "OR", "XOR"}
+
+def drop_count(node):
+    if prim(node) == "DROP":
+        return int_arg(node, 1)
+    return None
+
+def make_drop(n):
+    if n == 1:
+        return make("DROP")
+    return make("DROP", {"int": str(n)})
+
+def push_literal(node, types):
+    """The integer pushed by `PUSH <type> <int>` if `<type>` is in `types`."""
+    if prim(node) != "PUSH":
+        return None
+    (t, v) = args(node)
+    if prim(t) in types and not args(t) and "int" in v:
+        return (prim(t), int(v["int"]))
+    return None
+
+def push_bool(node):
+    if prim(node) == "PUSH" and prim(args(node)[0]) == "bool":
+        return prim(args(node)[1]) == "True"
+    return None
+
+class Peephole:
+    def __init__(self):
+        self.hits = collections.Counter()
+
+    def optimize_script(self, script):
+        return [self.optimize_node(section) for section in script]
+
+    def optimize_node(self, node):
+        if not isinstance(node, dict) or prim(node) not in CODE_ARGS:
+            return node
+        new_args = list(args(node))
+        for i in CODE_ARGS[prim(node)]:
+            if isinstance(new_args[i], list):
+                new_args[i] = self.optimize_seq(new_args[i])
+        result = dict(node)
+        result["args"] = new_args
+        return result
+
+    def optimize_seq(self, seq):
+        seq = [self.optimize_node(n) for n in self.flatten(seq)]
+        changed = True
+        while changed:
+            (seq, changed) = self.rewrite(seq)
+        return seq
+
+    def flatten(self, seq):
+        result = []
+        for n in seq:
+            if isinstance(n, list):
+                self.hits["nested sequence"] += 1
+                result.extend(self.flatten(n))
+            else:
+                result.append(n)
+        return result
+
+    def rewrite(self, seq):
+        """One left-to-right pass; returns the new sequence and whether
+        any rule applied."""
+        out = []
+        changed = False
+        i = 0
+        while i < len(seq):
+            window = seq[i:i + 3]
+            replacement = self.match(window)
+            if replacement is None:
+                out.append(seq[i])
+                i += 1
+            else:
+                (consumed, new, rule) = replacement
+                self.hits[rule] += 1
+                out.extend(new)
+                i += consumed
+                changed = True
+        return (self.flatten(out), changed)
+
+    def match(self, w):
+        """Returns `(consumed, replacement, rule name)` or `None`."""
+        a = w[0]
+        b = w[1] if len(w) > 1 else None
+        c = w[2] if len(w) > 2 else None
+        pa = prim(a)
+        pb = prim(b)
+
+        if pa in ("DIG", "DUG") and int_arg(a) == 0:
+            return (1, [], "DIG/DUG 0")
+        if pa == "DROP" and int_arg(a) == 0:
+            return (1, [], "DROP 0")
+        if pa in ("DIG", "DUG") and int_arg(a) == 1:
+            return (1, [make("SWAP")], "DIG/DUG 1 -> SWAP")
+        if pa == "DIP" and args(a) and args(a)[-1] == []:
+            return (1, [], "empty DIP")
+        if pa == "DIP" and len(args(a)) == 2 and args(a)[0] == {"int": "0"}:
+            return (1, [args(a)[1]], "DIP 0")
+        if pa == "SWAP" and pb == "SWAP":
+            return (2, [], "SWAP SWAP")
+        if pa == "DUP" and int_arg(a, 1) == 1 and pb == "SWAP":
+            return (2, [a], "DUP SWAP")
+        if pa == "SWAP" and pb in COMMUTATIVE:
+            return (2, [b], "SWAP before commutative")
+        if pa == "SWAP" and (drop_count(b) or 0) >= 2:
+            return (2, [b], "SWAP before DROP n")
+        if pa in PURE_PUSHES and (drop_count(b) or 0) >= 1:
+            n = drop_count(b)
+            return (2, [] if n == 1 else [make_drop(n - 1)], "dead push")
+        if drop_count(a) is not None and drop_count(b) is not None:
+            return (2, [make_drop(drop_count(a) + drop_count(b))], "DROP merge")
+        if pa == "NOT" and pb == "IF":
+            (then_, else_) = args(b)
+            return (2, [make("IF", else_, then_)], "NOT IF")
+        if push_bool(a) is not None and pb == "IF":
+            (then_, else_) = args(b)
+            return (2, [then_ if push_bool(a) else else_], "constant IF")
+        if pa == "IF" and canonical(args(a)[0]) == canonical(args(a)[1]):
+            return (1, [make("DROP"), args(a)[0]], "IF with equal branches")
+        if c is not None and prim(c) in ("ADD", "MUL"):
+            x = push_literal(a, ["nat", "int"])
+            y = push_literal(b, ["nat", "int"])
+            if x is not None and y is not None and x[0] == y[0]:
+                value = x[1] + y[1] if prim(c) == "ADD" else x[1] * y[1]
+                return (3, [make("PUSH", make(x[0]), {"int": str(value)})], "constant folding")
+        return None
+
+## ## Shared subroutines
+
+def code_sequences(node, found):
+    """Collects every code sequence of a script (see `CODE_ARGS`)."""
+    if isinstance(node, list):
+        for n in node:
+            code_sequences(n, found)
+    elif isinstance(node, dict) and prim(node) in CODE_ARGS:
+        for i in CODE_ARGS[prim(node)]:
+            sub = args(node)[i]
+            if isinstance(sub, list):
+                found.append(sub)
+                code_sequences(sub, found)
+
+def shared_subroutine_candidates(script, min_nodes = 12):
+    sequences = []
+    for section in script:
+        code_sequences(section, sequences)
+    counts = collections.Counter()
+    sizes = {}
+    for s in sequences:
+        key = canonical(s)
+        counts[key] += 1
+        sizes[key] = micheline.count_nodes(s)
+    candidates = [(sizes[k] * (n - 1), n, sizes[k], k)
+                  for (k, n) in counts.items() if n > 1 and sizes[k] >= min_nodes]
+    return sorted(candidates, reverse = True)
+
+## ## Command line
+
+def typecheck(octez_client, script):
+    with tempfile.NamedTemporaryFile("w", suffix = ".tz", delete = False) as f:
+        f.write(micheline.script_to_text(script))
+    try:
+        return subprocess.run(
+            [octez_client, "--mode", "mockup", "typecheck", "script", f.name, "--details"],
+            capture_output = True, text = True)
+    finally:
+        os.remove(f.name)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Peephole optimization of compiled Michelson.")
+    parser.add_argument("contract", help = "Micheline JSON of the compiled contract")
+    parser.add_argument("--output", help = "where to write the optimized Micheline JSON")
+    parser.add_argument("--tz", help = "where to write the optimized script as Michelson")
+    parser.add_argument("--octez-client", help = "type-check both versions with this client")
+    parser.add_argument("--candidates", type = int, default = 5,
+                        help = "number of shared-subroutine candidates to report")
+    options = parser.parse_args(argv)
+
+    script = micheline.load(options.contract)
+    peephole = Peephole()
+    optimized = peephole.optimize_script(script)
+
+    before = (micheline.count_nodes(script), len(micheline.script_to_text(script)))
+    after = (micheline.count_nodes(optimized), len(micheline.script_to_text(optimized)))
+    print("nodes:      %6d -> %6d (%+d)" % (before[0], after[0], after[0] - before[0]))
+    print("characters: %6d -> %6d (%+d)" % (before[1], after[1], after[1] - before[1]))
+    for (rule, n) in peephole.hits.most_common():
+        print("  %-28s %d" % (rule, n))
+
+    candidates = shared_subroutine_candidates(optimized)[:options.candidates]
+    if candidates:
+        print("shared-subroutine candidates (saved nodes, occurrences, size):")
+        for (saved, n, size, key) in candidates:
+            print("  %5d  %3d x %4d  %s" % (saved, n, size, key[:70]))
+
+    if options.output:
+        micheline.dump(optimized, options.output)
+    if options.tz:
+        with open(options.tz, "w") as f:
+            f.write(micheline.script_to_text(optimized))
+
+    if options.octez_client:
+        for (name, s) in [("original", script), ("optimized", optimized)]:
+            result = typecheck(options.octez_client, s)
+            print("== %s: %s" % (name, "well-typed" if result.returncode == 0 else "ILL-TYPED"))
+            print(result.stdout.strip() or result.stderr.strip())
+            if result.returncode != 0:
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+## Replays `Kraznik` workloads against the real protocol, offline.
+##
+## The SmartPy simulator only approximates gas. This runner originates the
+## compiled contract (e.g. `FA2_comp/step_000_cont_0_contract.tz`) in an
+## `octez-client` mockup, which runs the actual protocol without a node or
+## any network. It then replays a workload and records, for each operation,
+## the consumed milligas and the paid storage:
+##
+## - `add_test`: the flow of the `add_test` scenario (mints, metadata
+##   updates, transfers, operator updates, a rejected transfer), with steps
+##   named after the numbered steps of the scenario (`1. mint`,
+##   `4. transfer bob -> alice (2 txs)`...); `balance_of` (6.) needs a
+##   callback contract and is not replayed,
+## - `generated`: exactly `--operations` random mints, metadata updates and
+##   transfers between the bootstrap accounts, from a fixed `--seed`, with
+##   step names prefixed by their index (`007 mint 2`),
+## - or a JSON file given with `--workload`, a list of steps such as
+##   `{"name": "mint", "sender": "alice", "entrypoint": "mint", "arg": "1",
+##   "amount": "69", "valid": true}`. In `arg`, `{admin}`, `{alice}`,
+##   `{bob}` and `{operator}` stand for the addresses of the accounts.
+##
+## Accounts are the mockup's bootstrap accounts: admin is `bootstrap1`,
+## alice `bootstrap2`, bob `bootstrap3` and operator `bootstrap4`. The
+## administrator address in the initial storage (`--admin`) is replaced by
+## the admin's address.
+##
+## `--expected` takes a JSON object mapping step names to the gas that the
+## SmartPy simulator reported for them; steps that differ by more than
+## `--tolerance` percent are flagged. `--expected-template` writes that
+## object for the chosen workload with every value `null`, and exits; fill
+## it in from the gas of each call in the `log.html` written by
+## `SmartPy.sh test ... --html` (steps left `null` are not compared):
+##
+##     python tezos/tools/mockup_runner.py --workload add_test \
+##         --expected-template expected_gas.json
+##
+## Step names must be unique, and names that are not steps of the workload
+## are rejected, so that a renamed step cannot silently stop being compared.
+##
+## When several contracts are given, the workload is replayed on each and
+## the gas and storage deltas against the first one are reported, e.g. to
+## measure the output of `michelson_peephole.py`:
+##
+##     python tezos/tools/mockup_runner.py \
+##         FA2_comp/step_000_cont_0_contract.tz FA2_comp/contract.optimized.tz \
+##         --storage FA2_comp/step_000_cont_0_storage.tz --workload add_test
+import argparse
+import json
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ACCOUNTS = {
+    "admin": "bootstrap1",
+    "alice": "bootstrap2",
+    "bob": "bootstrap3",
+    "operator": "bootstrap4",
+}
+
+METADATA_VALUE = "0x697066732f2f3a3a" # "ipfs//::", as in `add_test`
+
+class Mockup_error(Exception):
+    pass
+
+## ## Workloads
+
+def step(name, sender, entrypoint, arg, amount = "0", valid = True):
+    return {"name": name, "sender": sender, "entrypoint": entrypoint,
+            "arg": arg, "amount": amount, "valid": valid}
+
+def transfer_arg(transfers):
+    """`transfers` is a list of `(from, [(to, token_id, amount)])`."""
+    return "{" + "; ".join(
+        'Pair "{%s}" {%s}' % (from_, "; ".join(
+            'Pair "{%s}" (Pair %d %d)' % (to_, token_id, amount) for (to_, token_id, amount) in txs))
+        for (from_, txs) in transfers) + "}"
+
+def metadata_arg(token_ids):
+    return "{" + "; ".join('Pair %d {Elt "" %s}' % (t, METADATA_VALUE) for t in token_ids) + "}"
+
+def operator_arg(updates):
+    """`updates` is a list of `(add, owner, operator, token_id)`."""
+    return "{" + "; ".join(
+        '%s (Pair "{%s}" (Pair "{%s}" %d))' % ("Left" if add else "Right", owner, operator, token_id)
+        for (add, owner, operator, token_id) in updates) + "}"
+
+def add_test_workload():
+    return [
+        step("1. mint", "alice", "mint", "1", amount = "69"),
+        step("2. update_token_metadata", "admin", "update_token_metadata", metadata_arg([0])),
+        step("3. transfer alice -> bob", "alice", "transfer", transfer_arg([("alice", [("bob", 0, 1)])])),
+        step("4. mint 2", "bob", "mint", "2", amount = "138"),
+        step("4. update_token_metadata 2", "admin", "update_token_metadata", metadata_arg([1, 2])),
+        step("4. transfer bob -> alice (2 txs)", "bob", "transfer",
+             transfer_arg([("bob", [("alice", 1, 1), ("alice", 2, 1)])])),
+        step("5. transfer of another user's token", "bob", "transfer",
+             transfer_arg([("alice", [("bob", 0, 1)]), ("bob", [("alice", 1, 1)])]), valid = False),
+        step("7. update_operators (2 adds)", "admin", "update_operators",
+             operator_arg([(True, "bob", "operator", 0), (True, "alice", "operator", 2)])),
+        step("7. transfer as operator", "operator", "transfer",
+             transfer_arg([("bob", [("alice", 0, 1)]), ("alice", [("operator", 2, 1)])])),
+    ]
+
+def generated_workload(operations, seed):
+    """`operations` steps, each a mint, a metadata update of the tokens
+    minted since the last one, or a transfer by a user who owns tokens."""
+    rng = random.Random(seed)
+    owners = {}
+    untagged = []
+    users = ["alice", "bob", "operator"]
+    steps = []
+    while len(steps) < operations:
+        r = rng.random()
+        if not owners or r < 0.2:
+            minter = rng.choice(users)
+            count = rng.choice([1, 2])
+            first = len(owners)
+            steps.append(step("%03d mint %d" % (len(steps), count), minter, "mint", str(count), amount = str(69 * count)))
+            for t in range(first, first + count):
+                owners[t] = minter
+                untagged.append(t)
+        elif untagged and r < 0.35:
+            steps.append(step("%03d update_token_metadata %d" % (len(steps), len(untagged)), "admin",
+                              "update_token_metadata", metadata_arg(untagged)))
+            untagged = []
+        else:
+            sender = rng.choice(sorted(set(owners.values())))
+            tokens = [t for (t, o) in owners.items() if o == sender]
+            txs = []
+            for t in rng.sample(tokens, min(len(tokens), rng.choice([1, 1, 2, 5]))):
+                to_ = rng.choice([u for u in users if u != sender])
+                txs.append((to_, t, 1))
+                owners[t] = to_
+            steps.append(step("%03d transfer (%d txs)" % (len(steps), len(txs)), sender, "transfer",
+                              transfer_arg([(sender, txs)])))
+    return steps
+
+## ## Mockup client
+
+class Mockup:
+    def __init__(self, octez_client, protocol = None):
+        self.octez_client = octez_client
+        self.base_dir = tempfile.mkdtemp(prefix = "kraznik-mockup-")
+        command = ["create", "mockup"]
+        if protocol:
+            command = ["--protocol", protocol] + command
+        self.run(command)
+        self.addresses = dict([(name, self.address(alias)) for (name, alias) in ACCOUNTS.items()])
+
+    def close(self):
+        shutil.rmtree(self.base_dir, ignore_errors = True)
+
+    def run(self, command, check = True):
+        result = subprocess.run(
+            [self.octez_client, "--mode", "mockup", "--base-dir", self.base_dir] + command,
+            capture_output = True, text = True)
+        if check and result.returncode != 0:
+            raise Mockup_error(" ".join(command) + "\n" + result.stderr)
+        return result
+
+    def address(self, alias):
+        output = self.run(["show", "address", alias]).stdout
+        return re.search(r"Hash: (\w+)", output).group(1)
+
+    def substitute(self, text):
+        for (name, address) in self.addresses.items():
+            text = text.replace("{%s}" % name, address)
+        return text
+
+    def originate(self, alias, script, storage):
+        result = self.run(["originate", "contract", alias, "transferring", "0",
+                           "from", ACCOUNTS["admin"], "running", script,
+                           "--init", storage, "--burn-cap", "100", "--force"])
+        return measure(result.stdout)
+
+    def call(self, contract, s):
+        result = self.run(["transfer", s["amount"], "from", ACCOUNTS[s["sender"]], "to", contract,
+                           "--entrypoint", s["entrypoint"], "--arg", self.substitute(s["arg"]),
+                           "--burn-cap", "10"], check = False)
+        measures = measure(result.stdout)
+        measures["applied"] = result.returncode == 0
+        if not measures["applied"]:
+            measures["error"] = result.stderr.strip().splitlines()[-1:] or [""]
+        return measures
+
+def measure(output):
+    """Total consumed milligas and paid storage of the operations in an
+    `octez-client` receipt (including internal operations)."""
+    gas = sum(round(float(g) * 1000) for g in re.findall(r"Consumed gas: ([\d.]+)", output))
+    paid = sum(int(p) for p in re.findall(r"Paid storage size diff: (-?\d+) bytes", output))
+    return {"milligas": gas, "paid_storage": paid}
+
+## ## Command line
+
+def replay(mockup, name, script, storage, steps, expected, tolerance):
+    origination = mockup.originate(name, script, storage)
+    print("== %s: origination %d milligas, %d bytes" % (script, origination["milligas"], origination["paid_storage"]))
+    results = []
+    for s in steps:
+        m = mockup.call(name, s)
+        m["name"] = s["name"]
+        flag = ""
+        if m["applied"] != s["valid"]:
+            flag = "UNEXPECTED %s" % ("SUCCESS" if m["applied"] else "FAILURE: " + m["error"][0])
+        elif expected.get(s["name"]) is not None and m["applied"]:
+            simulated = expected[s["name"]] * 1000
+            m["divergence"] = (m["milligas"] - simulated) / max(simulated, 1)
+            if abs(m["divergence"]) * 100 > tolerance:
+                flag = "DIVERGES from simulator by %+.1f%%" % (100 * m["divergence"])
+        print("  %-40s %10d milligas %6d bytes  %s" % (s["name"], m["milligas"], m["paid_storage"], flag))
+        m["flag"] = flag
+        results.append(m)
+    return {"contract": script, "origination": origination, "steps": results}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Replay Kraznik workloads in an octez-client mockup.")
+    parser.add_argument("contracts", nargs = "*", help = "compiled contracts (.tz); the first is the reference")
+    parser.add_argument("--storage", help = "initial storage (.tz) written by SmartPy")
+    parser.add_argument("--admin", default = "tz1M9CMEtsXm3QxA7FmMU2Qh7xzsuGXVbcDr",
+                        help = "administrator address to replace in the initial storage")
+    parser.add_argument("--workload", default = "add_test",
+                        help = "`add_test`, `generated` or a JSON file of steps")
+    parser.add_argument("--operations", type = int, default = 100, help = "size of the generated workload")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--expected", help = "JSON object of simulator gas per step name")
+    parser.add_argument("--expected-template",
+                        help = "write the `--expected` object of the workload, with null values, and exit")
+    parser.add_argument("--tolerance", type = float, default = 10.0, help = "allowed divergence, in percent")
+    parser.add_argument("--octez-client", default = "octez-client")
+    parser.add_argument("--protocol", help = "protocol hash for the mockup (default: the client's)")
+    parser.add_argument("--report", help = "where to write the JSON report")
+    options = parser.parse_args(argv)
+
+    if options.workload == "add_test":
+        steps = add_test_workload()
+    elif options.workload == "generated":
+        steps = generated_workload(options.operations, options.seed)
+    else:
+        with open(options.workload) as f:
+            steps = [step(**s) for s in json.load(f)]
+    names = [s["name"] for s in steps]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise Mockup_error("step names must be unique: " + ", ".join(duplicates))
+    if options.expected_template:
+        with open(options.expected_template, "w") as f:
+            json.dump(dict.fromkeys(names), f, indent = 2)
+        return 0
+    if not options.contracts or not options.storage:
+        parser.error("contracts and --storage are required")
+    expected = {}
+    if options.expected:
+        with open(options.expected) as f:
+            expected = json.load(f)
+        unknown = sorted(set(expected) - set(names))
+        if unknown:
+            raise Mockup_error("not steps of the workload: " + ", ".join(unknown))
+
+    reports = []
+    for (i, script) in enumerate(options.contracts):
+        # A fresh mockup per contract, so that every contract replays the
+        # workload from the same state.
+        mockup = Mockup(options.octez_client, options.protocol)
+        try:
+            with open(options.storage) as f:
+                storage = f.read().replace(options.admin, mockup.addresses["admin"])
+            reports.append(replay(mockup, "kraznik%d" % i, script, storage, steps, expected, options.tolerance))
+        finally:
+            mockup.close()
+
+    reference = reports[0]
+    for report in reports[1:]:
+        print("== %s vs. %s" % (report["contract"], reference["contract"]))
+        for (a, b) in zip(reference["steps"], report["steps"]):
+            print("  %-40s %+10d milligas %+6d bytes" % (
+                a["name"], b["milligas"] - a["milligas"], b["paid_storage"] - a["paid_storage"]))
+
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(reports, f, indent = 2)
+    flagged = [s for r in reports for s in r["steps"] if s["flag"]]
+    return 1 if flagged else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+## Times the SmartPy engine on each test of `KraznikCollections.py`.
+##
+## A scenario script only records actions; type inference, compilation to
+## Michelson, simulation and the HTML output are done by the SmartPy engine
+## after the script has returned, so they can only be timed from outside.
+## This tool runs `SmartPy.sh test` once per test (selected with the
+## `only_test` environment variable of the script) and reports, per test:
+##
+## - `script`: the time of the scenario script itself, as printed by its
+##   opt-in profiler (`profile_build=true`),
+## - `engine`: the wall time of the run, minus the script time and the
+##   time of a run that registers no test (interpreter and engine
+##   start-up),
+## - `html`: the extra wall time of the same run with `--html`.
+##
+## Each run is repeated `--repeat` times and the fastest one is kept:
+##
+##     python tezos/tools/profile_build.py tezos/contracts/KraznikCollections.py
+##
+## Environment parameters of the script (e.g. `only_environment_test=true`)
+## are passed through; `--headless` sets `headless=true`, the mode CI uses,
+## so that the `engine` column is the time of a CI run of each test.
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+class Profile_error(Exception):
+    pass
+
+def run_smartpy(smartpy, script, env, html = False):
+    """Wall time and standard output of one `SmartPy.sh test` run."""
+    output = tempfile.mkdtemp(prefix = "kraznik-profile-")
+    command = [smartpy, "test", script, output] + (["--html"] if html else [])
+    try:
+        start = time.perf_counter()
+        result = subprocess.run(command, env = dict(os.environ, **env),
+                                capture_output = True, text = True)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output, ignore_errors = True)
+    if result.returncode != 0:
+        raise Profile_error(" ".join(command) + "\n" + result.stderr)
+    return (elapsed, result.stdout)
+
+def fastest(repeat, f):
+    runs = [f() for _ in range(repeat)]
+    return min(runs, key = lambda run: run[0])
+
+def script_time(stdout):
+    match = re.search(r"^Scenario script profile: .* \(([\d.]+) ms\)$", stdout, re.MULTILINE)
+    return float(match.group(1)) / 1000 if match else None
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Time the SmartPy engine on each test.")
+    parser.add_argument("script", help = "scenario script, e.g. tezos/contracts/KraznikCollections.py")
+    parser.add_argument("--smartpy", default = os.path.expanduser("~/smartpy-cli/SmartPy.sh"),
+                        help = "path to the SmartPy CLI")
+    parser.add_argument("--test", action = "append", default = [],
+                        help = "test to profile (can be repeated; default: all)")
+    parser.add_argument("--repeat", type = int, default = 1)
+    parser.add_argument("--skip-html", action = "store_true", help = "do not time the `--html` runs")
+    parser.add_argument("--headless", action = "store_true",
+                        help = "run the tests in headless mode (no presentation)")
+    options = parser.parse_args(argv)
+
+    def run(env, html = False):
+        if options.headless:
+            env = dict(env, headless = "true")
+        return fastest(options.repeat,
+                       lambda: run_smartpy(options.smartpy, options.script, env, html))
+
+    # Listing the tests registers none of them: that run is the baseline.
+    (baseline, listing) = run({"list_tests": "true"})
+    tests = options.test or re.findall(r"^test: (.*)$", listing, re.MULTILINE)
+    print("start-up: %.3f s" % baseline)
+    print("%-50s %9s %9s %9s" % ("test", "script", "engine", "html"))
+    for test in tests:
+        env = {"only_test": test, "profile_build": "true"}
+        (elapsed, stdout) = run(env)
+        script = script_time(stdout)
+        html = None
+        if not options.skip_html:
+            html = run(env, html = True)[0] - elapsed
+        print("%-50s %9s %9s %9s" % (
+            test,
+            "-" if script is None else "%.3f s" % script,
+            "%.3f s" % (elapsed - baseline - (script or 0)),
+            "-" if html is None else "%.3f s" % html))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
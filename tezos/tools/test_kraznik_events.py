@@ -0,0 +1,95 @@
+## Tests of `kraznik_events.py` on a recorded block
+## (`testdata/kraznik_events_block.json`: a transfer, a mint with an
+## operator update and a metadata update, an event of another contract and
+## a backtracked mint) and on a fake chain that reorganises.
+##
+##     python -m pytest tezos/tools
+import copy
+import itertools
+import json
+import os
+import unittest
+
+from kraznik_events import decode, events_of_block, stream
+
+BLOCK = os.path.join(os.path.dirname(__file__), "testdata", "kraznik_events_block.json")
+
+ALICE = "tz1gjaF81ZRRvdzjobyfVNsAeSC6PScjfQwN"
+BOB = "tz1faswCTDciRzE4oJ9jn2Vm2dvjeyA9fUzU"
+OPERATOR = "tz1b7tUupMgCNw2cCLpKTkSD1NZzB5TkP2sv"
+CONTRACT = "KT1BEqzn5Wx8uJrZNvuS9DVHmLvG9td3fDLi"
+
+def load_block():
+    with open(BLOCK) as f:
+        return json.load(f)
+
+class Decoders(unittest.TestCase):
+    def test_events_of_block(self):
+        events = events_of_block(load_block(), CONTRACT)
+        self.assertEqual([(e.level, e.operation, e.tag) for e in events], [
+            (120, "ooTransfer", "transfer"),
+            (120, "ooMint", "mint"),
+            (120, "ooMint", "operators"),
+            (120, "ooMint", "token_metadata"),
+        ])
+        # The sender of the transfer is in optimized (`bytes`) form, and its
+        # second tx a flat `Pair`.
+        self.assertEqual(events[0].data, [{"from_": ALICE, "txs": [
+            {"to_": BOB, "token_id": 0, "amount": 1},
+            {"to_": OPERATOR, "token_id": 2, "amount": 1}]}])
+        self.assertEqual(events[1].data, {"owner": BOB, "token_id": 3, "count": 2})
+        self.assertEqual(events[2].data, [
+            {"add_operator": {"owner": BOB, "operator": OPERATOR, "token_id": 3}},
+            {"remove_operator": {"owner": ALICE, "operator": OPERATOR, "token_id": 0}}])
+        self.assertEqual(events[3].data, [3, 4])
+
+    def test_unknown_tag(self):
+        with self.assertRaises(ValueError):
+            decode("burn", {"int": "0"})
+
+## Serves the RPC paths `stream` uses from blocks by level, which the test
+## can replace to simulate a reorganisation. Each poll of the head first
+## bakes the next of the `future` blocks, if any, as if the chain had moved
+## on between two polls.
+class Fake_chain:
+    def __init__(self, levels, future = ()):
+        self.blocks = {}
+        for level in levels:
+            self.bake(level)
+        self.future = list(future)
+
+    def bake(self, level, tag = ""):
+        block = copy.deepcopy(load_block())
+        block["header"] = {"level": level, "hash": "b%d%s" % (level, tag)}
+        for group in block["operations"][3]:
+            group["hash"] += tag
+        self.blocks[level] = block
+
+    def get(self, path):
+        if path == "/chains/main/blocks/head/header":
+            if self.future:
+                self.bake(self.future.pop(0))
+            return self.blocks[max(self.blocks)]["header"]
+        return self.blocks[int(path.rsplit("/", 1)[1])]
+
+class Stream(unittest.TestCase):
+    def test_only_final_blocks_are_read(self):
+        chain = Fake_chain([10, 11, 12, 13])
+        events = stream(chain.get, CONTRACT, interval = 0, start = 10)
+        levels = [e.level for e in itertools.islice(events, 8)]
+        self.assertEqual(levels, [10] * 4 + [11] * 4)
+        # Block 12 is not final yet: it is replaced before it is read, and
+        # only its replacement's events are yielded.
+        chain.bake(12, "x")
+        chain.bake(14)
+        operations = set(e.operation for e in itertools.islice(events, 4))
+        self.assertEqual(operations, {"ooTransferx", "ooMintx"})
+
+    def test_default_start_is_the_next_final_block(self):
+        # Head 13 when the stream starts: 11 is final already, 12 is next.
+        chain = Fake_chain([10, 11, 12], future = [13, 14])
+        events = stream(chain.get, CONTRACT, interval = 0)
+        self.assertEqual(set(e.level for e in itertools.islice(events, 4)), {12})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+## Tests of `kraznik_gateway.py` against the replaying stand-in node
+## (`testdata/kraznik_recording.json`: a transfer, a mint, an operator
+## update, a metadata update and an operator removal, one block each) and
+## against a fake RPC chain with reorganisations and failures.
+##
+##     python -m pytest tezos/tools
+import os
+import re
+import unittest
+
+from kraznik_gateway import Gateway_error, Kraznik_gateway, Recorded_node, Rpc_node
+
+RECORDING = os.path.join(os.path.dirname(__file__), "testdata", "kraznik_recording.json")
+
+ALICE = "tz1gjaF81ZRRvdzjobyfVNsAeSC6PScjfQwN"
+BOB = "tz1faswCTDciRzE4oJ9jn2Vm2dvjeyA9fUzU"
+OPERATOR = "tz1b7tUupMgCNw2cCLpKTkSD1NZzB5TkP2sv"
+CONTRACT = "KT1BEqzn5Wx8uJrZNvuS9DVHmLvG9td3fDLi"
+
+class Recorded(unittest.TestCase):
+    def setUp(self):
+        self.node = Recorded_node.load(RECORDING)
+        self.gateway = Kraznik_gateway(self.node)
+        self.metrics = self.gateway.metrics
+
+    def counts(self, method):
+        return (self.metrics.hits[method], self.metrics.misses[method])
+
+    def next_block(self):
+        self.assertTrue(self.node.next_block())
+        self.assertEqual(self.gateway.sync(), 1)
+
+    def test_metrics_are_recorded_under_the_public_method(self):
+        for _ in range(4):
+            self.assertEqual(self.gateway.get_balance(ALICE, 0), 1)
+        self.assertEqual(self.counts("get_balance"), (3, 1))
+        # The token set was loaded by the first `get_balance`.
+        self.assertEqual(self.gateway.count_tokens(), 2)
+        self.assertEqual(self.gateway.count_tokens(), 2)
+        self.assertEqual(self.counts("count_tokens"), (2, 0))
+        self.assertEqual(self.gateway.all_tokens(), [0, 1])
+        self.assertEqual(self.counts("all_tokens"), (1, 0))
+        self.assertEqual(set(self.metrics.hits) | set(self.metrics.misses),
+                         {"get_balance", "count_tokens", "all_tokens"})
+        self.assertEqual(self.node.requests, 2)
+
+    def test_tokens_exist_once_minted(self):
+        self.assertEqual(self.gateway.get_balance(BOB, 1), 1)
+        self.assertEqual(self.gateway.get_balance(ALICE, 1), 0)
+        with self.assertRaises(Gateway_error):
+            self.gateway.get_balance(ALICE, 2)
+        self.node.next_block()
+        self.node.next_block()
+        self.gateway.sync()
+        # Minted, but no metadata yet.
+        self.assertEqual(self.gateway.get_balance(ALICE, 2), 1)
+        with self.assertRaises(Gateway_error):
+            self.gateway.token_metadata(2)
+
+    def test_replay(self):
+        # Warm the cache.
+        self.assertEqual(self.gateway.get_balance(ALICE, 0), 1)
+        self.assertEqual(self.gateway.get_balance(BOB, 0), 0)
+        self.assertEqual(self.gateway.get_balance(BOB, 1), 1)
+        self.assertEqual(self.gateway.count_tokens(), 2)
+        self.assertFalse(self.gateway.is_operator(BOB, OPERATOR, 0))
+        with self.assertRaises(Gateway_error):
+            self.gateway.token_metadata(2)
+        self.assertEqual(self.gateway.sync(), 0)
+
+        # Transfer: only the two ledger keys it touched are dropped.
+        self.next_block()
+        self.assertEqual(self.metrics.invalidations["ledger"], 2)
+        before = self.counts("get_balance")
+        self.assertEqual(self.gateway.get_balance(ALICE, 0), 0)
+        self.assertEqual(self.gateway.get_balance(BOB, 0), 1)
+        self.assertEqual(self.gateway.get_balance(BOB, 1), 1)
+        self.assertEqual(self.counts("get_balance"), (before[0] + 1, before[1] + 2))
+
+        # Mint: the token set and the minter's balances.
+        self.assertEqual(self.gateway.count_tokens(), 2)
+        self.next_block()
+        self.assertEqual(self.metrics.invalidations["mint"], 1)
+        self.assertEqual(self.gateway.count_tokens(), 4)
+        self.assertEqual(self.gateway.get_balance(ALICE, 2), 1)
+        self.assertEqual(self.gateway.get_balance(BOB, 1), 1)
+
+        # Operators.
+        self.next_block()
+        self.assertEqual(self.metrics.invalidations["operators"], 1)
+        self.assertTrue(self.gateway.is_operator(BOB, OPERATOR, 0))
+        self.assertTrue(self.gateway.is_operator(BOB, OPERATOR, 0))
+
+        # Metadata.
+        self.next_block()
+        self.assertEqual(self.metrics.invalidations["token_metadata"], 2)
+        self.assertEqual(self.gateway.token_metadata(2)["token_id"], 2)
+
+        # Operator removal.
+        self.next_block()
+        self.assertFalse(self.gateway.is_operator(BOB, OPERATOR, 0))
+        self.assertEqual(self.metrics.invalidations["operators"], 2)
+        self.assertEqual(self.counts("is_operator"), (1, 3))
+        self.assertNotIn("flush", self.metrics.invalidations)
+        self.assertFalse(self.node.next_block())
+
+    def test_unknown_entry_points_flush_the_cache(self):
+        self.gateway.get_balance(ALICE, 0)
+        self.gateway.apply({"entrypoint": "upgrade", "sender": ALICE, "parameters": None})
+        self.assertEqual(self.metrics.invalidations["flush"], 1)
+        self.assertEqual(len(self.gateway.cache.entries), 0)
+
+    def test_advancing_node(self):
+        node = Recorded_node.load(RECORDING, advance = True)
+        gateway = Kraznik_gateway(node)
+        self.assertEqual([gateway.sync() for _ in range(6)], [1, 1, 1, 1, 1, 0])
+        self.assertEqual(gateway.count_tokens(), 4)
+
+## A chain of blocks served through the RPC paths `Rpc_node` uses.
+class Fake_chain(Rpc_node):
+    def __init__(self):
+        Rpc_node.__init__(self, "http://localhost:8732", CONTRACT)
+        self.blocks = {}
+        self.head_hash = None
+        self.failures = set()
+
+    def bake(self, hash, predecessor, calls = ()):
+        level = self.blocks[predecessor]["header"]["level"] + 1 if predecessor else 10
+        self.blocks[hash] = {
+            "header": {"hash": hash, "level": level, "predecessor": predecessor},
+            "operations": [{"contents": [transfer_content(*call) for call in calls]}],
+        }
+        self.head_hash = hash
+
+    def rpc(self, path, body = None):
+        self.requests += 1
+        if path in self.failures:
+            raise OSError("unreachable: " + path)
+        match = re.match(r"^/chains/main/blocks/(\w+)/(header|operations/3)$", path)
+        block = self.blocks[self.head_hash if match.group(1) == "head" else match.group(1)]
+        return block["header"] if match.group(2) == "header" else block["operations"]
+
+def transfer_content(from_, to_, token_id):
+    tx = {"prim": "Pair", "args": [{"string": to_},
+                                   {"prim": "Pair", "args": [{"int": str(token_id)}, {"int": "1"}]}]}
+    return {"kind": "transaction", "source": from_, "destination": CONTRACT,
+            "parameters": {"entrypoint": "transfer",
+                           "value": [{"prim": "Pair", "args": [{"string": from_}, [tx]]}]},
+            "metadata": {"operation_result": {"status": "applied"}}}
+
+class Reorganisations(unittest.TestCase):
+    def setUp(self):
+        self.chain = Fake_chain()
+        self.chain.bake("b10", None)
+        self.assertEqual(self.chain.new_operations(), [])
+
+    def test_blocks_are_followed_in_order(self):
+        self.chain.bake("b11", "b10", [(ALICE, BOB, 0)])
+        self.chain.bake("b12", "b11", [(BOB, ALICE, 0)])
+        self.chain.bake("b13", "b12")
+        operations = self.chain.new_operations()
+        self.assertEqual([o["parameters"][0]["from_"] for o in operations], [ALICE, BOB])
+        self.assertEqual(sorted(self.chain.hashes), [11, 12, 13])
+        self.assertEqual(self.chain.new_operations(), [])
+
+    def test_replaced_block_flushes_the_cache(self):
+        gateway = Kraznik_gateway(self.chain)
+        self.chain.bake("b11", "b10", [(ALICE, BOB, 0)])
+        self.assertEqual(gateway.sync(), 1)
+        gateway.cache.put(("ledger", BOB, 1), 0)
+        # `b11` is replaced by a block at the same level without the transfer.
+        self.chain.bake("c11", "b10")
+        self.chain.bake("c12", "c11", [(ALICE, BOB, 1)])
+        self.assertEqual(gateway.sync(), 2)
+        self.assertEqual(gateway.metrics.invalidations["reorg"], 1)
+        self.assertEqual(len(gateway.cache.entries), 0)
+        self.assertEqual(self.chain.hashes, {10: "b10", 11: "c11", 12: "c12"})
+
+    def test_reorganisation_deeper_than_the_known_levels(self):
+        self.chain.bake("b11", "b10")
+        self.chain.bake("b12", "b11")
+        self.chain.bake("b13", "b12")
+        self.chain.new_operations()
+        self.chain.bake("c11", "b10")
+        self.chain.bake("c12", "c11")
+        self.chain.bake("c13", "c12")
+        self.chain.bake("c14", "c13")
+        self.assertEqual(self.chain.new_operations(), [{"reorg": True}])
+        self.assertEqual(self.chain.hashes, {12: "c12", 13: "c13", 14: "c14"})
+
+class Failed_syncs(unittest.TestCase):
+    def setUp(self):
+        self.chain = Fake_chain()
+        self.chain.bake("b10", None)
+        self.gateway = Kraznik_gateway(self.chain)
+        self.assertEqual(self.gateway.sync(), 0)
+        self.gateway.cache.put(("ledger", BOB, 0), 0)
+
+    def test_blocks_of_a_failed_sync_are_read_again(self):
+        self.chain.bake("b11", "b10", [(ALICE, BOB, 0)])
+        self.chain.bake("b12", "b11")
+        self.chain.failures.add("/chains/main/blocks/b12/operations/3")
+        self.assertIsNone(self.gateway.try_sync())
+        self.assertEqual(self.gateway.metrics.invalidations["sync_error"], 1)
+        self.assertEqual(len(self.gateway.cache.entries), 0)
+        self.assertEqual(self.chain.hashes, {10: "b10"})
+        self.gateway.cache.put(("ledger", BOB, 0), 0)
+        self.chain.failures.clear()
+        self.assertEqual(self.gateway.try_sync(), 1)
+        self.assertEqual(self.gateway.cache.get(("ledger", BOB, 0)), (False, None))
+
+    def test_any_error_flushes_the_cache(self):
+        self.chain.bake("b11", "b10", [(ALICE, BOB, 0)])
+        # An address the decoder does not know (tz4).
+        self.chain.blocks["b11"]["operations"][0]["contents"][0]["parameters"]["value"][0]["args"][0] = \
+            {"bytes": "0003" + "00" * 20}
+        self.assertIsNone(self.gateway.try_sync())
+        self.assertEqual(len(self.gateway.cache.entries), 0)
+        self.assertEqual(self.gateway.metrics.invalidations["sync_error"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
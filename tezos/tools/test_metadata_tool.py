@@ -0,0 +1,84 @@
+## Tests of `metadata_tool.py` on a small hand-written metadata document.
+##
+##     python -m pytest tezos/tools
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from metadata_tool import main, minified, shrink, size, strip_variable_annotations
+
+CODE = [{"prim": "UNPAIR", "annots": ["@params", "@storage"]},
+        {"prim": "CAR", "annots": ["%ledger", "@ledger"]},
+        {"prim": "DIP", "args": [[{"prim": "DROP", "annots": ["@x"]}]]}]
+
+DOCUMENT = {
+    "name": "Kraznik",
+    "version": "1.0.0",
+    "source": {"tools": ["SmartPy"]},
+    "build": "internal field, not TZIP-016",
+    "views": [{
+        "name": "get_balance",
+        "description": "Balance of an owner for a token.",
+        "pure": True,
+        "implementations": [{"michelsonStorageView": {
+            "parameterType": {"prim": "nat"},
+            "returnType": {"prim": "nat"},
+            "code": CODE,
+            "annotations": [{"name": "%ledger", "description": "the ledger"}],
+        }}],
+    }],
+}
+
+class Shrink(unittest.TestCase):
+    def test_strip_variable_annotations(self):
+        self.assertEqual(strip_variable_annotations(CODE), [
+            {"prim": "UNPAIR"},
+            {"prim": "CAR", "annots": ["%ledger"]},
+            {"prim": "DIP", "args": [[{"prim": "DROP"}]]}])
+        # Literals are left alone.
+        self.assertEqual(strip_variable_annotations({"string": "@x"}), {"string": "@x"})
+
+    def test_shrink(self):
+        shrunk = shrink(DOCUMENT, drop = ["source"])
+        self.assertEqual(sorted(shrunk), ["name", "version", "views"])
+        view = shrunk["views"][0]
+        self.assertNotIn("description", view)
+        code = view["implementations"][0]["michelsonStorageView"]
+        self.assertNotIn("annotations", code)
+        self.assertEqual(code["code"], strip_variable_annotations(CODE))
+        self.assertLess(size(shrunk), size(DOCUMENT))
+        # The input is not modified.
+        self.assertIn("description", DOCUMENT["views"][0])
+
+    def test_keep_descriptions(self):
+        view = shrink(DOCUMENT, keep_descriptions = True)["views"][0]
+        self.assertIn("description", view)
+        self.assertIn("annotations", view["implementations"][0]["michelsonStorageView"])
+
+class Budget(unittest.TestCase):
+    def run_tool(self, budget):
+        with tempfile.TemporaryDirectory() as d:
+            (source, output) = (os.path.join(d, "metadata.json"), os.path.join(d, "min.json"))
+            with open(source, "w") as f:
+                json.dump(DOCUMENT, f)
+            with contextlib.redirect_stdout(io.StringIO()):
+                status = main([source, "--output", output, "--budget", str(budget)])
+            written = None
+            if os.path.exists(output):
+                with open(output) as f:
+                    written = f.read()
+            return (status, written)
+
+    def test_within_budget(self):
+        (status, written) = self.run_tool(10000)
+        self.assertEqual(status, 0)
+        self.assertEqual(written, minified(shrink(DOCUMENT)))
+
+    def test_over_budget_writes_nothing(self):
+        self.assertEqual(self.run_tool(10), (1, None))
+
+if __name__ == "__main__":
+    unittest.main()
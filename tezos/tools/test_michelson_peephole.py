@@ -0,0 +1,139 @@
+## Tests of the rewrite rules of `michelson_peephole.py`: one input/output
+## pair per rule, and near misses that must be left alone.
+##
+##     python -m pytest tezos/tools
+import unittest
+
+from micheline import make
+from michelson_peephole import Peephole
+
+def i(name, *arguments):
+    return make(name, *arguments)
+
+def n(value):
+    return {"int": str(value)}
+
+def push(t, value):
+    return i("PUSH", i(t), n(value))
+
+def push_bool(value):
+    return i("PUSH", i("bool"), i("True" if value else "False"))
+
+class Rules(unittest.TestCase):
+    def check(self, seq, expected, rule = None):
+        peephole = self.peephole = Peephole()
+        self.assertEqual(peephole.optimize_seq(seq), expected)
+        if rule is None:
+            self.assertEqual(dict(peephole.hits), {})
+        else:
+            self.assertIn(rule, peephole.hits)
+
+    def test_dig_dug_0(self):
+        self.check([i("DIG", n(0)), i("CAR")], [i("CAR")], "DIG/DUG 0")
+        self.check([i("DUG", n(0)), i("CAR")], [i("CAR")], "DIG/DUG 0")
+
+    def test_drop_0(self):
+        self.check([i("DROP", n(0)), i("CAR")], [i("CAR")], "DROP 0")
+
+    def test_dig_dug_1(self):
+        self.check([i("DIG", n(1))], [i("SWAP")], "DIG/DUG 1 -> SWAP")
+        self.check([i("DUG", n(1))], [i("SWAP")], "DIG/DUG 1 -> SWAP")
+        self.check([i("DIG", n(2))], [i("DIG", n(2))])
+
+    def test_empty_dip(self):
+        self.check([i("DIP", []), i("CAR")], [i("CAR")], "empty DIP")
+        self.check([i("DIP", n(3), []), i("CAR")], [i("CAR")], "empty DIP")
+
+    def test_dip_0(self):
+        self.check([i("DIP", n(0), [i("CAR")])], [i("CAR")], "DIP 0")
+        self.check([i("DIP", n(1), [i("CAR")])], [i("DIP", n(1), [i("CAR")])])
+
+    def test_swap_swap(self):
+        self.check([i("SWAP"), i("SWAP"), i("CAR")], [i("CAR")], "SWAP SWAP")
+
+    def test_dup_swap(self):
+        self.check([i("DUP"), i("SWAP")], [i("DUP")], "DUP SWAP")
+        self.check([i("DUP", n(1)), i("SWAP")], [i("DUP", n(1))], "DUP SWAP")
+
+    def test_dup_2_swap_is_kept(self):
+        self.check([i("DUP", n(2)), i("SWAP")], [i("DUP", n(2)), i("SWAP")])
+
+    def test_swap_before_commutative(self):
+        for name in ["ADD", "OR", "XOR"]:
+            self.check([i("SWAP"), i(name)], [i(name)], "SWAP before commutative")
+
+    def test_swap_before_non_commutative_is_kept(self):
+        for name in ["SUB", "MUL", "AND", "COMPARE", "CONS", "PAIR"]:
+            self.check([i("SWAP"), i(name)], [i("SWAP"), i(name)])
+
+    def test_swap_before_drop_n(self):
+        self.check([i("SWAP"), i("DROP", n(2))], [i("DROP", n(2))], "SWAP before DROP n")
+        self.check([i("SWAP"), i("DROP")], [i("SWAP"), i("DROP")])
+
+    def test_dead_push(self):
+        self.check([push("nat", 1), i("DROP"), i("CAR")], [i("CAR")], "dead push")
+        self.check([i("UNIT"), i("DROP", n(3))], [i("DROP", n(2))], "dead push")
+        self.check([i("DUP", n(2)), i("DROP")], [], "dead push")
+
+    def test_push_before_drop_0_is_not_dead(self):
+        # `DROP 0` is removed on its own; the push stays.
+        self.check([push("nat", 1), i("DROP", n(0))], [push("nat", 1)], "DROP 0")
+        self.assertNotIn("dead push", self.peephole.hits)
+
+    def test_consuming_instruction_before_drop_is_kept(self):
+        self.check([i("UNPACK", i("nat")), i("DROP")], [i("UNPACK", i("nat")), i("DROP")])
+        self.check([i("ADD"), i("DROP")], [i("ADD"), i("DROP")])
+
+    def test_drop_merge(self):
+        self.check([i("DROP"), i("DROP", n(2))], [i("DROP", n(3))], "DROP merge")
+
+    def test_not_if(self):
+        self.check([i("NOT"), i("IF", [i("CAR")], [i("CDR")])],
+                   [i("IF", [i("CDR")], [i("CAR")])], "NOT IF")
+
+    def test_constant_if(self):
+        self.check([push_bool(True), i("IF", [i("CAR")], [i("CDR")])], [i("CAR")], "constant IF")
+        self.check([push_bool(False), i("IF", [i("CAR")], [i("CDR")])], [i("CDR")], "constant IF")
+
+    def test_if_with_equal_branches(self):
+        self.check([i("IF", [i("CDR")], [i("CDR")])], [i("DROP"), i("CDR")], "IF with equal branches")
+        self.check([i("IF", [i("CAR")], [i("CDR")])], [i("IF", [i("CAR")], [i("CDR")])])
+
+    def test_constant_folding(self):
+        self.check([push("nat", 2), push("nat", 3), i("ADD")], [push("nat", 5)], "constant folding")
+        self.check([push("int", -2), push("int", 3), i("MUL")], [push("int", -6)], "constant folding")
+
+    def test_folding_near_misses_are_kept(self):
+        # `mutez` arithmetic can fail on overflow, mixed types change the
+        # result type, and `SUB` is not folded.
+        for seq in [[push("mutez", 1), push("mutez", 2), i("ADD")],
+                    [push("nat", 1), push("int", 2), i("ADD")],
+                    [push("nat", 3), push("nat", 2), i("SUB")]]:
+            self.check(seq, seq)
+
+    def test_nested_sequences_are_flattened(self):
+        self.check([[i("CAR")], i("CDR")], [i("CAR"), i("CDR")], "nested sequence")
+
+    def test_code_inside_nested_sequences_is_rewritten(self):
+        self.check([[i("IF", [i("SWAP"), i("SWAP")], [i("CAR")])]], [i("IF", [], [i("CAR")])], "SWAP SWAP")
+        self.check([[[i("DIP", n(1), [i("DIG", n(0))])]]], [], "empty DIP")
+
+    def test_code_arguments_are_rewritten(self):
+        self.check([i("IF", [i("SWAP"), i("SWAP")], [i("CAR")])],
+                   [i("IF", [], [i("CAR")])], "SWAP SWAP")
+        self.check([i("LAMBDA", i("nat"), i("nat"), [i("DIG", n(0))])],
+                   [i("LAMBDA", i("nat"), i("nat"), [])], "DIG/DUG 0")
+
+    def test_data_arguments_are_kept(self):
+        # A lambda literal is data: `PUSH` has no code argument.
+        seq = [i("PUSH", i("lambda", i("nat"), i("nat")), [i("DIG", n(0))]), i("CAR")]
+        self.check(seq, seq)
+
+    def test_script_sections(self):
+        script = [i("parameter", i("unit")), i("storage", i("unit")),
+                  i("code", [i("SWAP"), i("SWAP"), i("CDR")])]
+        self.assertEqual(Peephole().optimize_script(script),
+                         script[:2] + [i("code", [i("CDR")])])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+## Tests of the workloads of `mockup_runner.py`; replaying them needs
+## `octez-client` and is not tested here.
+##
+##     python -m pytest tezos/tools
+import json
+import os
+import re
+import tempfile
+import unittest
+
+from mockup_runner import Mockup_error, add_test_workload, generated_workload, main
+
+class Workloads(unittest.TestCase):
+    def test_generated_workload_has_the_requested_size(self):
+        for n in [1, 2, 10, 100]:
+            self.assertEqual(len(generated_workload(n, seed = 3)), n)
+        self.assertEqual(generated_workload(50, seed = 3), generated_workload(50, seed = 3))
+
+    def test_generated_step_names_are_unique(self):
+        names = [s["name"] for s in generated_workload(100, seed = 0)]
+        self.assertEqual(len(set(names)), 100)
+        self.assertEqual(names[0], "000 mint %s" % generated_workload(1, seed = 0)[0]["arg"])
+
+    def test_duplicate_step_names_are_rejected(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "workload.json")
+            with open(path, "w") as f:
+                json.dump([{"name": "mint", "sender": "alice", "entrypoint": "mint", "arg": "1"}] * 2, f)
+            with self.assertRaises(Mockup_error):
+                main(["--workload", path, "--expected-template", os.path.join(d, "expected.json")])
+
+    def test_generated_transfers_only_move_owned_tokens(self):
+        owners = {}
+        for s in generated_workload(200, seed = 1):
+            if s["entrypoint"] == "mint":
+                for _ in range(int(s["arg"])):
+                    owners[len(owners)] = s["sender"]
+            elif s["entrypoint"] == "transfer":
+                for (to_, token_id) in re.findall(r'Pair "\{(\w+)\}" \(Pair (\d+) 1\)', s["arg"]):
+                    self.assertEqual(owners[int(token_id)], s["sender"])
+                    owners[int(token_id)] = to_
+            else:
+                self.assertEqual(s["entrypoint"], "update_token_metadata")
+
+    def test_expected_template(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "expected.json")
+            self.assertEqual(main(["--workload", "add_test", "--expected-template", path]), 0)
+            with open(path) as f:
+                template = json.load(f)
+        self.assertEqual(list(template), [s["name"] for s in add_test_workload()])
+        self.assertEqual(set(template.values()), {None})
+
+    def test_unknown_expected_steps_are_rejected(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "expected.json")
+            with open(path, "w") as f:
+                json.dump({"mint 1": 1000}, f)
+            with self.assertRaises(Mockup_error):
+                main(["contract.tz", "--storage", "storage.tz", "--expected", path])
+
+if __name__ == "__main__":
+    unittest.main()